@@ -0,0 +1,105 @@
+"""Compare SmartReact's old per-emoji matching with the trigger index.
+
+Run from the repo root:
+
+    python benchmarks/smartreact_matching.py
+    python benchmarks/smartreact_matching.py --triggers 100 5000 --messages 50000
+
+The old path is what on_message did per message: deep-copy the guild's
+reactions, then intersect every emoji's trigger set with the message
+words. The new path is one TriggerIndex.match per message, with the index
+built once. Both must pick the same emojis, in the same order.
+
+Only the standard library and smartreact/matcher.py are needed, so this
+runs without Red installed.
+"""
+import argparse
+import copy
+import importlib.util
+import os
+import random
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_matcher():
+    # Load by path, importing the smartreact package needs Red
+    spec = importlib.util.spec_from_file_location(
+        "smartreact_matcher", os.path.join(ROOT, "smartreact", "matcher.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+matcher = load_matcher()
+
+
+def synthetic_reactions(triggers, emojis, rng):
+    """`triggers` trigger words spread over `emojis` emoji strings."""
+    reactions = {}
+    for i in range(triggers):
+        n = rng.randrange(emojis)
+        emoji = f"<:emoji{n}:{10**17 + n}>"
+        reactions.setdefault(emoji, []).append(f"trigger{i}")
+    return reactions
+
+
+def synthetic_messages(count, triggers, rng, hit_rate=0.05):
+    """Chat-like messages, a few of them containing a trigger word."""
+    words = [f"word{i}" for i in range(5000)]
+    messages = []
+    for _ in range(count):
+        msg = rng.choices(words, k=rng.randint(1, 25))
+        if rng.random() < hit_rate:
+            msg.insert(rng.randrange(len(msg) + 1), f"Trigger{rng.randrange(triggers)}")
+        messages.append(" ".join(msg))
+    return messages
+
+
+def old_path(reactions, messages):
+    matched = []
+    for content in messages:
+        reacts = copy.deepcopy(reactions)
+        words = content.lower().split()
+        matched.append(
+            [e for e in reacts if set(w.lower() for w in reacts[e]).intersection(words)]
+        )
+    return matched
+
+
+def new_path(reactions, messages):
+    index = matcher.TriggerIndex(reactions)
+    return [index.match(content) for content in messages]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--triggers", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--emojis", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'triggers':>8} {'emojis':>6} {'old msg/s':>10} {'new msg/s':>10} {'speedup':>8}")
+    for triggers in args.triggers:
+        reactions = synthetic_reactions(triggers, args.emojis, rng)
+        messages = synthetic_messages(args.messages, triggers, rng)
+        old_time, old_matched = timed(old_path, reactions, messages)
+        new_time, new_matched = timed(new_path, reactions, messages)
+        assert old_matched == new_matched, "trigger index disagrees with the old matching"
+        print(
+            f"{triggers:>8} {len(reactions):>6} {args.messages / old_time:>10.0f} "
+            f"{args.messages / new_time:>10.0f} {old_time / new_time:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Time each stage of the wordcloud pipeline on synthetic corpora.
+
+Run from the repo root, with the cog's requirements installed:
+
+    python benchmarks/wordclouds_generate.py
+    python benchmarks/wordclouds_generate.py --messages 10000 100000 --masks none ring
+    python benchmarks/wordclouds_generate.py --profile profiles/
+
+Stages are text prep (URL stripping, tokenizing, counting), layout and
+encoding, the last two measured inside image.generate exactly as the cog
+runs it. Each case runs in a fresh process so peak RSS is per case. With
+--profile, a cProfile dump per case is written to the given directory.
+
+History fetching isn't covered, it depends on Discord rather than this code.
+"""
+import argparse
+import cProfile
+import importlib.util
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from wordclouds_text import synthetic_corpus  # noqa: E402
+
+
+def load_module(name):
+    # Load by path, importing the wordclouds package needs Red
+    spec = importlib.util.spec_from_file_location(
+        f"wordclouds_{name}", os.path.join(ROOT, "wordclouds", f"{name}.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_mask(shape, size=800):
+    """Masks in the format WordCloud expects: 255 is masked out, 0 is drawn on."""
+    import numpy as np
+
+    if shape == "none":
+        return None
+    y, x = np.ogrid[:size, :size]
+    distance = np.hypot(x - size / 2, y - size / 2)
+    if shape == "circle":
+        inside = distance < size * 0.45
+    elif shape == "ring":
+        # Thin shapes leave few places for words, layout has to search harder
+        inside = (distance < size * 0.45) & (distance > size * 0.35)
+    elif shape == "large":
+        return synthetic_mask("circle", size * 3)
+    else:
+        raise ValueError(f"Unknown mask shape {shape}")
+    return np.where(inside, 0, 255).astype(np.uint8)
+
+
+def run_case(messages, vocabulary, mask_shape, output_format, profile_dir):
+    from wordcloud import STOPWORDS
+
+    text = load_module("text")
+    image = load_module("image")
+    profiler = cProfile.Profile() if profile_dir else None
+    if profiler:
+        profiler.enable()
+
+    corpus = synthetic_corpus(messages, vocabulary)
+    mask = synthetic_mask(mask_shape)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    counter = text.WordCounter(STOPWORDS)
+    for message in corpus:
+        counter.feed(message)
+    timings = {"text": time.perf_counter() - start}
+    _, text_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    _, stage_timings = image.generate(
+        counter.counts, output_format=output_format, mask=mask, width=800, height=600
+    )
+    timings.update(stage_timings)
+
+    if profiler:
+        profiler.disable()
+        name = f"{messages}-{vocabulary}-{mask_shape}-{output_format}.prof"
+        profiler.dump_stats(os.path.join(profile_dir, name))
+
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        rss *= 1024
+    return timings, text_peak, rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--vocabulary", type=int, nargs="+", default=[1000, 20000])
+    parser.add_argument(
+        "--masks", nargs="+", default=["none", "circle", "ring", "large"],
+        choices=["none", "circle", "ring", "large"],
+    )
+    parser.add_argument("--formats", nargs="+", default=["png"], choices=["png", "webp", "jpeg"])
+    parser.add_argument("--profile", metavar="DIR", help="write a cProfile dump per case here")
+    args = parser.parse_args()
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+
+    header = (
+        f"{'messages':>9} {'vocab':>6} {'mask':>6} {'format':>6} "
+        f"{'text s':>7} {'layout s':>9} {'encode s':>9} {'text MiB':>9} {'RSS MiB':>8}"
+    )
+    print(header)
+    for messages in args.messages:
+        for vocabulary in args.vocabulary:
+            for mask_shape in args.masks:
+                for output_format in args.formats:
+                    # Fresh process per case, otherwise peak RSS only ever grows
+                    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                        timings, text_peak, rss = pool.submit(
+                            run_case, messages, vocabulary, mask_shape, output_format, args.profile
+                        ).result()
+                    print(
+                        f"{messages:>9} {vocabulary:>6} {mask_shape:>6} {output_format:>6} "
+                        f"{timings['text']:>7.3f} {timings['layout']:>9.3f} "
+                        f"{timings['encode']:>9.3f} {text_peak / 2**20:>9.2f} {rss / 2**20:>8.1f}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
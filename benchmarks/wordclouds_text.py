@@ -0,0 +1,163 @@
+"""Compare the old concatenate-then-regex text prep with the streaming counter.
+
+Run from the repo root:
+
+    python benchmarks/wordclouds_text.py [message counts...]
+    python benchmarks/wordclouds_text.py --adversarial
+
+--adversarial times link stripping on inputs built to make regexes
+backtrack, plus random fuzz, and fails if the time per character grows
+with input length.
+
+The old path needs the wordcloud package, but not Red. Timing only
+--adversarial needs neither.
+"""
+import gc
+import importlib.util
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_text_module():
+    # Load the module by path, importing the wordclouds package needs Red
+    spec = importlib.util.spec_from_file_location(
+        "wordclouds_text", os.path.join(ROOT, "wordclouds", "text.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+text = load_text_module()
+
+# The URL pattern the cog used before strip_urls, kept here for comparison
+OLD_URL_RE = re.compile(
+    r"([\w+]+\:\/\/)?([\w\d-]+\.)*[\w-]+[\.\:]\w+([\/\?\=\&\#]?[\w-]+)*\/?", flags=re.I
+)
+
+
+def synthetic_corpus(messages, vocabulary=5000, seed=0):
+    """Messages of 1-30 words drawn from a Zipf-ish vocabulary, some with links."""
+    rng = random.Random(seed)
+    words = [f"word{i}" for i in range(vocabulary)]
+    weights = [1 / (i + 1) for i in range(vocabulary)]
+    corpus = []
+    for _ in range(messages):
+        msg = rng.choices(words, weights, k=rng.randint(1, 30))
+        if rng.random() < 0.05:
+            msg.append(f"https://example.com/{rng.choice(words)}?q={rng.randint(0, 999)}")
+        corpus.append(" ".join(msg))
+    return corpus
+
+
+# Case and plurals are folded the way process_text does it
+FOLDING_SAMPLE = ["Cats and cats", "Python python pythons", "it's Bob's 42 class"]
+
+
+def old_path(corpus, stopwords):
+    # What WordClouds.wordcloud did before: one giant string, one regex pass,
+    # then WordCloud.generate. Collocations are off, the new path has none.
+    from wordcloud import WordCloud
+
+    blob = ""
+    for message in corpus:
+        blob += message + " "
+    blob = OLD_URL_RE.sub("", blob)
+    return WordCloud(stopwords=stopwords, collocations=False).process_text(blob)
+
+
+def new_path(corpus, stopwords):
+    counter = text.WordCounter(stopwords)
+    for message in corpus:
+        counter.feed(message)
+    return counter.counts
+
+
+def measure(func, *args):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(sizes):
+    stopwords = {"word0", "word1", "word2"}
+    folded = new_path(FOLDING_SAMPLE, {"and"})
+    assert folded == old_path(FOLDING_SAMPLE, {"and"}), folded
+    print(f"{'messages':>10} {'path':>6} {'seconds':>9} {'peak MiB':>9}")
+    for size in sizes:
+        corpus = synthetic_corpus(size)
+        old, old_time, old_peak = measure(old_path, corpus, stopwords)
+        new, new_time, new_peak = measure(new_path, corpus, stopwords)
+        # The new stripper only removes real links, the old regex also ate
+        # things like "a.b", so the counts only agree on this clean corpus
+        assert old == new, "streaming counter disagrees with process_text"
+        print(f"{size:>10} {'old':>6} {old_time:>9.3f} {old_peak / 2**20:>9.2f}")
+        print(f"{size:>10} {'new':>6} {new_time:>9.3f} {new_peak / 2**20:>9.2f}")
+
+
+ADVERSARIAL = {
+    # One long token with no separator: the old pattern rescans it from every offset
+    "long word": lambda n: "a" * n,
+    "hyphens": lambda n: "a-" * (n // 2) + "!",
+    "dotted": lambda n: "a." * (n // 2) + "!",
+    "dotted domain": lambda n: "a." * (n // 2) + "com",
+    "markup-like": lambda n: "<@" + "1" * (n - 2),
+    "emoji-like": lambda n: "<a:" + "x" * (n - 3),
+}
+
+
+def time_per_char(func, sample, repeat=3):
+    best = min(_timed(func, sample) for _ in range(repeat))
+    return best / len(sample)
+
+
+def _timed(func, sample):
+    start = time.perf_counter()
+    func(sample)
+    return time.perf_counter() - start
+
+
+def adversarial(lengths=(1000, 4000, 16000)):
+    """Time both strippers on worst-case inputs and random fuzz.
+
+    Linear code takes roughly the same time per character at every length,
+    so the new stripper fails if that grows more than 4x from the shortest
+    to the longest input (the old one grows ~16x on several inputs here).
+    """
+    old = lambda sample: OLD_URL_RE.sub("", sample)  # noqa: E731
+    rng = random.Random(0)
+    alphabet = "a1-._:/?=&#<>@!:~ "
+    cases = dict(ADVERSARIAL)
+    cases["fuzz"] = lambda n: "".join(rng.choice(alphabet) for _ in range(n))
+
+    print(f"{'input':>14} {'length':>7} {'old ns/char':>12} {'new ns/char':>12}")
+    failed = False
+    for name, build in cases.items():
+        new_times = []
+        for length in lengths:
+            sample = build(length)
+            old_time = time_per_char(old, sample, repeat=1)
+            new_time = time_per_char(text.strip_urls, sample)
+            new_times.append(new_time)
+            print(f"{name:>14} {length:>7} {old_time * 1e9:>12.1f} {new_time * 1e9:>12.1f}")
+        if new_times[-1] > 4 * new_times[0]:
+            print(f"  strip_urls is not linear on {name!r}")
+            failed = True
+    return not failed
+
+
+if __name__ == "__main__":
+    if "--adversarial" in sys.argv[1:]:
+        sys.exit(0 if adversarial() else 1)
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
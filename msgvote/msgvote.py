@@ -1,12 +1,18 @@
 import asyncio
-from datetime import datetime
+import re
+import time
+from collections import OrderedDict
 
 import discord
 from redbot.core import Config, checks, commands
 
+from .settings import GuildSettings
+
 # Credit to JennJenn#6857 for thinking up this cog.
 # It started as a joke, and people actualy use it! Who knew?
 
+CUSTOM_EMOJI_RE = re.compile(r"<a?:\w+:(\d+)>")
+
 
 class MsgVote(commands.Cog):
     """Turn Discord channels into Reddit-like threads"""
@@ -24,11 +30,42 @@ class MsgVote(commands.Cog):
             "dn_emoji": "👎",
         }
         self.config.register_guild(**default_guild)
+        # guild id -> GuildSettings, see _guild_settings
+        self._settings = {}
+        # emoji string -> custom emoji id, or None for unicode emojis
+        self._emoji_ids = {}
+        # message id -> [guild id, channel id, upvotes, downvotes, stop
+        # counting at], for messages still within their guild's duration
+        self._tallies = OrderedDict()
 
     async def red_delete_data_for_user(self, **kwargs):
         """Nothing to delete."""
         return
 
+    async def _guild_settings(self, guild):
+        settings = self._settings.get(guild.id)
+        if settings is None:
+            settings = GuildSettings(await self.config.guild(guild).all())
+            self._resolve_emojis(settings)
+            self._settings[guild.id] = settings
+        elif settings.up is None or settings.dn is None:
+            # An emoji from a guild that's unavailable or still loading
+            # doesn't resolve yet, a deleted one never will. Looking again
+            # is only a cache lookup, so keep trying.
+            self._resolve_emojis(settings)
+        return settings
+
+    def _resolve_emojis(self, settings):
+        settings.up = self.fix_custom_emoji(settings.up_emoji)
+        settings.dn = self.fix_custom_emoji(settings.dn_emoji)
+        settings.up_key = self._emoji_key(settings.up)
+        settings.dn_key = self._emoji_key(settings.dn)
+
+    async def cog_after_invoke(self, ctx):
+        # Every msgvote command may have changed the settings
+        if ctx.guild is not None:
+            self._settings.pop(ctx.guild.id, None)
+
     @commands.group(autohelp=False)
     @commands.guild_only()
     @checks.admin_or_permissions(manage_guild=True)
@@ -161,83 +198,133 @@ class MsgVote(commands.Cog):
             )
 
     def fix_custom_emoji(self, emoji):
-        if emoji[:2] != "<:":
+        try:
+            emoji_id = self._emoji_ids[emoji]
+        except KeyError:
+            match = CUSTOM_EMOJI_RE.fullmatch(emoji)
+            emoji_id = self._emoji_ids[emoji] = int(match[1]) if match else None
+        if emoji_id is None:
             return emoji
-        for guild in self.bot.guilds:
-            for e in guild.emojis:
-                if str(e.id) == emoji.split(":")[2][:-1]:
-                    return e
-        return None
+        return self.bot.get_emoji(emoji_id)
+
+    @staticmethod
+    def _emoji_key(emoji):
+        """What a raw reaction event's emoji is compared by: id, or the unicode emoji."""
+        return emoji.id if isinstance(emoji, discord.Emoji) else emoji
+
+    @commands.Cog.listener()
+    async def on_guild_emojis_update(self, guild, before, after):
+        # Settings hold resolved emojis, which may be from any guild
+        self._settings.clear()
+
+    @commands.Cog.listener()
+    async def on_guild_unavailable(self, guild):
+        self._settings.clear()
 
     @commands.Cog.listener()
     async def on_message(self, message):
         if isinstance(message.channel, discord.abc.PrivateChannel):
             return
-        guild_data = await self.config.guild(message.guild).all()
-        try:
-            test = guild_data["channels_enabled"]
-        except KeyError:
+        settings = await self._guild_settings(message.guild)
+        if message.channel.id not in settings.channels:
             return
-        if message.channel.id not in await self.config.guild(message.guild).channels_enabled():
-            return
-        if (
-            message.author.id == self.bot.user.id
-            and not await self.config.guild(message.guild).bot_react()
-        ):
+        if message.author.id == self.bot.user.id and not settings.bot_react:
             return
         # Still need to fix error (discord.errors.NotFound) on first run of cog
         # must be due to the way the emoji is stored in settings/json
+        if settings.up is None or settings.dn is None:
+            return
+        self._expire_tallies()
+        # The bot's own votes cancel out, so counting starts at zero
+        self._tallies[message.id] = [
+            message.guild.id,
+            message.channel.id,
+            0,
+            0,
+            time.monotonic() + settings.duration,
+        ]
         try:
-            up_emoji = self.fix_custom_emoji(await self.config.guild(message.guild).up_emoji())
-            dn_emoji = self.fix_custom_emoji(await self.config.guild(message.guild).dn_emoji())
-            await message.add_reaction(up_emoji)
+            await message.add_reaction(settings.up)
             await asyncio.sleep(0.5)
-            await message.add_reaction(dn_emoji)
+            await message.add_reaction(settings.dn)
         except discord.errors.HTTPException:
             # Implement a non-spammy way to alert users in future
-            pass
+            self._tallies.pop(message.id, None)
+
+    def _expire_tallies(self):
+        # Roughly oldest first. Entries with a shorter duration behind a
+        # longer one are caught when they're next voted on.
+        now = time.monotonic()
+        while self._tallies:
+            tally = next(iter(self._tallies.values()))
+            if tally[4] > now:
+                break
+            self._tallies.popitem(last=False)
 
     @commands.Cog.listener()
-    async def on_reaction_add(self, reaction, user):
-        if user.id == self.bot.user.id:
-            return
-        await self.count_votes(reaction)
+    async def on_raw_reaction_add(self, payload):
+        await self._count_vote(payload, 1)
 
     @commands.Cog.listener()
-    async def on_reaction_remove(self, reaction, user):
-        if user.id == self.bot.user.id:
-            return
-        await self.count_votes(reaction)
+    async def on_raw_reaction_remove(self, payload):
+        await self._count_vote(payload, -1)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(self, payload):
+        # Every vote is gone, the bot's included, so it's back to zero
+        tally = self._tallies.get(payload.message_id)
+        if tally is not None:
+            tally[2] = tally[3] = 0
 
-    async def count_votes(self, reaction):
-        message = reaction.message
-        if not message.guild:
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(self, payload):
+        tally = self._tallies.get(payload.message_id)
+        guild = self.bot.get_guild(payload.guild_id)
+        if tally is None or guild is None:
             return
-        if not reaction.me:
+        settings = await self._guild_settings(guild)
+        key = payload.emoji.id or payload.emoji.name
+        if key == settings.up_key:
+            tally[2] = 0
+        elif key == settings.dn_key:
+            tally[3] = 0
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        self._tallies.pop(payload.message_id, None)
+
+    async def _count_vote(self, payload, change):
+        self._expire_tallies()
+        tally = self._tallies.get(payload.message_id)
+        if tally is None or payload.user_id == self.bot.user.id:
             return
-        if await self.config.guild(message.guild).threshold() == 0:
+        if tally[4] < time.monotonic():
+            del self._tallies[payload.message_id]
             return
-        if message.channel.id not in await self.config.guild(message.guild).channels_enabled():
+        guild = self.bot.get_guild(tally[0])
+        if guild is None:
             return
-        up_emoji = self.fix_custom_emoji(await self.config.guild(message.guild).up_emoji())
-        dn_emoji = self.fix_custom_emoji(await self.config.guild(message.guild).dn_emoji())
-        if reaction.emoji not in (up_emoji, dn_emoji):
+        settings = await self._guild_settings(guild)
+        key = payload.emoji.id or payload.emoji.name
+        if key == settings.up_key:
+            tally[2] += change
+        elif key == settings.dn_key:
+            tally[3] += change
+        else:
             return
-        age = (datetime.utcnow() - message.created_at).total_seconds()
-        if age > await self.config.guild(message.guild).duration():
+        channel_id = tally[1]
+        if settings.threshold == 0 or channel_id not in settings.channels:
             return
-        # We have a valid vote so we can count the votes now
-        upvotes = 0
-        dnvotes = 0
-        for react in message.reactions:
-            if react.emoji == up_emoji:
-                upvotes = react.count
-            elif react.emoji == dn_emoji:
-                dnvotes = react.count
-        if (dnvotes - upvotes) >= await self.config.guild(message.guild).threshold():
+        if (tally[3] - tally[2]) >= settings.threshold:
+            del self._tallies[payload.message_id]
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                return
             try:
-                await message.delete()
+                await channel.get_partial_message(payload.message_id).delete()
             except discord.errors.Forbidden:
-                await message.channel.send(
+                await channel.send(
                     "I require the 'Manage Messages' permission to delete downvoted messages!"
                 )
+            except discord.errors.NotFound:
+                pass
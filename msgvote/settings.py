@@ -0,0 +1,21 @@
+class GuildSettings:
+    """In-memory copy of a guild's MsgVote settings, for the listeners.
+
+    Built from `config.guild(guild).all()` and dropped by the msgvote
+    commands whenever they change something, so message and reaction
+    events never have to touch Config.
+    """
+
+    def __init__(self, data):
+        self.channels = set(data["channels_enabled"])
+        self.bot_react = data["bot_react"]
+        self.duration = data["duration"]
+        self.threshold = data["threshold"]
+        self.up_emoji = data["up_emoji"]
+        self.dn_emoji = data["dn_emoji"]
+        # The emojis themselves, resolved once by the cog, and what raw
+        # reaction events are matched against
+        self.up = None
+        self.dn = None
+        self.up_key = None
+        self.dn_key = None
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger("red.flapjackcogs.smartreact")
+
+# Discord allows about one reaction per quarter second per channel
+REACTION_RATE = 4
+REACTION_BURST = 2
+# Reactions that couldn't be placed within this many seconds are dropped
+MAX_AGE = 30
+# Messages waiting for reactions per channel, the oldest are dropped first
+MAX_PENDING = 50
+
+
+class TokenBucket:
+    def __init__(self, loop, rate, capacity):
+        self.loop = loop
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = loop.time()
+
+    async def take(self):
+        while True:
+            now = self.loop.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ReactionDispatcher:
+    """Places reactions one channel at a time, at the rate Discord allows.
+
+    Matched (emoji, trigger) pairs are queued per message, and a message
+    matching again before its reactions are placed only adds the emojis
+    it didn't have. Each channel with work queued gets a task that takes a
+    token from that channel's bucket for every reaction, so a raid fills
+    our queue rather than discord.py's rate limit handling. Work for
+    deleted messages, and anything older than `max_age` seconds, is
+    dropped instead of retried.
+
+    `react(message, emoji, trigger)` places one reaction and returns False
+    when the rest of that message's reactions should be given up on.
+    """
+
+    def __init__(
+        self,
+        loop,
+        react,
+        rate=REACTION_RATE,
+        burst=REACTION_BURST,
+        max_age=MAX_AGE,
+        max_pending=MAX_PENDING,
+    ):
+        self.loop = loop
+        self.react = react
+        self.rate = rate
+        self.burst = burst
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self.dropped = 0
+        # channel id -> OrderedDict of message id -> [message, hits, queued at]
+        self._pending = {}
+        self._workers = {}
+        # channel id -> TokenBucket, kept between workers until it's full again
+        self._buckets = {}
+
+    def submit(self, message, hits):
+        channel_id = message.channel.id
+        queue = self._pending.setdefault(channel_id, OrderedDict())
+        entry = queue.get(message.id)
+        if entry is None:
+            queue[message.id] = [message, list(hits), self.loop.time()]
+            while len(queue) > self.max_pending:
+                _, (_, dropped, _) = queue.popitem(last=False)
+                self.dropped += len(dropped)
+        else:
+            queued = {emoji for emoji, _ in entry[1]}
+            entry[1].extend(hit for hit in hits if hit[0] not in queued)
+        if channel_id not in self._workers:
+            self._workers[channel_id] = self.loop.create_task(self._work(channel_id))
+
+    def discard(self, channel_id, message_id):
+        """Forget a message's queued reactions, like when it's deleted."""
+        queue = self._pending.get(channel_id)
+        if queue:
+            queue.pop(message_id, None)
+
+    async def _work(self, channel_id):
+        bucket = self._buckets.get(channel_id)
+        if bucket is None:
+            bucket = self._buckets[channel_id] = TokenBucket(self.loop, self.rate, self.burst)
+        queue = self._pending[channel_id]
+        try:
+            while queue:
+                message_id, entry = next(iter(queue.items()))
+                message, emojis, queued = entry
+                if self.loop.time() - queued > self.max_age:
+                    del queue[message_id]
+                    self.dropped += len(emojis)
+                    continue
+                if not emojis:
+                    del queue[message_id]
+                    continue
+                await bucket.take()
+                # The message may have been deleted or dropped while waiting
+                if queue.get(message_id) is not entry:
+                    continue
+                emoji, trigger = emojis.pop(0)
+                try:
+                    keep_going = await self.react(message, emoji, trigger)
+                except Exception:
+                    log.exception("Adding reaction %s failed", emoji)
+                    keep_going = True
+                if not keep_going:
+                    queue.pop(message_id, None)
+        finally:
+            del self._workers[channel_id]
+            if not queue:
+                self._pending.pop(channel_id, None)
+            # A new bucket is as good as this one once it has refilled
+            self.loop.call_later(self.burst / self.rate, self._forget_bucket, channel_id, bucket)
+
+    def _forget_bucket(self, channel_id, bucket):
+        if channel_id not in self._workers and self._buckets.get(channel_id) is bucket:
+            del self._buckets[channel_id]
+
+    def close(self):
+        for task in self._workers.values():
+            task.cancel()
+        self._pending.clear()
+        self._buckets.clear()
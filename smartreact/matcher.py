@@ -0,0 +1,311 @@
+import logging
+import re
+import time
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+log = logging.getLogger("red.flapjackcogs.smartreact")
+
+# Kinds of trigger, told apart by how they're written:
+#   word          a whole word, as split on whitespace
+#   good morning  a phrase, words in a row, punctuation around them ignored
+#   lol*          any word starting with "lol"
+#   *lol*         "lol" anywhere in the message
+#   re:l(o|u)l    a regular expression, matched case-insensitively
+WORD, PHRASE, STEM, SUBSTRING, REGEX = "word", "phrase", "stem", "substring", "regex"
+REGEX_PREFIX = "re:"
+
+# Only this much of a message is looked at, and less by regexes, whose
+# worst case grows faster than the length of the message
+MAX_SCAN_LENGTH = 4000
+REGEX_SCAN_LENGTH = 500
+MAX_REGEX_LENGTH = 200
+MAX_SUBSTRING_LENGTH = 100
+# The most triggers of these kinds a guild can have
+LIMITS = {REGEX: 10, SUBSTRING: 500}
+# Regexes get this long per message. Python can't interrupt a search in
+# progress, so the rest are skipped once it's used up, and a guild whose
+# regexes go over it a few times in a row has them switched off for a while.
+REGEX_BUDGET = 0.005
+REGEX_STRIKES = 3
+REGEX_PAUSE = 300
+
+PUNCTUATION = "!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~"
+_REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT}
+_REPEATS.add(getattr(sre_parse, "POSSESSIVE_REPEAT", sre_parse.MAX_REPEAT))
+
+
+def trigger_kind(trigger):
+    if trigger.startswith(REGEX_PREFIX):
+        return REGEX
+    if len(trigger) > 2 and trigger.startswith("*") and trigger.endswith("*"):
+        return SUBSTRING
+    if len(trigger) > 1 and trigger.endswith("*") and not trigger[:-1].endswith("*"):
+        return STEM
+    if len(trigger.split()) > 1:
+        return PHRASE
+    return WORD
+
+
+def normalize_trigger(trigger):
+    """The form a trigger is stored in. Regexes keep their case."""
+    trigger = trigger.strip()
+    if trigger_kind(trigger) == REGEX:
+        return trigger
+    return " ".join(trigger.lower().split())
+
+
+def validate_trigger(trigger):
+    """Raise ValueError, with a message for the user, for unusable triggers."""
+    kind = trigger_kind(trigger)
+    if kind == REGEX:
+        validate_regex(trigger[len(REGEX_PREFIX):])
+    elif kind == PHRASE and not all(w.strip(PUNCTUATION) for w in trigger.split()):
+        raise ValueError("Phrases can only be made of words.")
+    elif kind == STEM and len(trigger.split()) > 1:
+        raise ValueError("Only single words can end in `*`, like `lol*`.")
+    elif kind == SUBSTRING and len(trigger) - 2 > MAX_SUBSTRING_LENGTH:
+        raise ValueError(
+            "Text to find anywhere can be up to {} characters long.".format(MAX_SUBSTRING_LENGTH)
+        )
+    return trigger
+
+
+def check_limits(reactions):
+    """Raise ValueError if a guild's reactions have too many costly triggers."""
+    counts = dict.fromkeys(LIMITS, 0)
+    for triggers in reactions.values():
+        for trigger in triggers:
+            kind = trigger_kind(trigger)
+            if kind in counts:
+                counts[kind] += 1
+    for kind, count in counts.items():
+        if count > LIMITS[kind]:
+            raise ValueError(
+                "A server can have at most {} {} triggers, that would make {}.".format(
+                    LIMITS[kind], kind, count
+                )
+            )
+
+
+def validate_regex(pattern):
+    if not pattern:
+        raise ValueError("That regex is empty.")
+    if len(pattern) > MAX_REGEX_LENGTH:
+        raise ValueError("Regexes can be up to {} characters long.".format(MAX_REGEX_LENGTH))
+    try:
+        compiled = re.compile(pattern)
+        parsed = sre_parse.parse(pattern)
+    except re.error as e:
+        raise ValueError("That's not a valid regex: {}.".format(e))
+    if compiled.groupindex:
+        raise ValueError("Regexes can't use named groups.")
+    if compiled.flags & ~re.UNICODE:
+        raise ValueError("Regexes can't set flags for the whole pattern, use `(?i:...)` instead.")
+    if _check_safe(parsed, False) > 1:
+        raise ValueError(
+            "Regexes can only repeat one thing a varying number of times, "
+            "like `lo+l` or `colou?r`."
+        )
+
+
+def _check_safe(parsed, repeated):
+    """Reject what makes a backtracking matcher take exponential time.
+
+    That's a repeat inside a repeat like (a+)+, alternation inside a repeat
+    like (a|ab)*, and backreferences. Returns how many repeats vary in
+    length, since even a row of them like a*a*b is polynomial, but far too
+    slow. Stricter than needed, which is fine for reaction triggers.
+    """
+    varying = 0
+    for op, av in parsed:
+        if op in _REPEATS:
+            low, high, item = av
+            if repeated and high != low:
+                raise ValueError("Regexes can't nest repeats, like `(a+)+`.")
+            varying += (high != low) + _check_safe(item, repeated or high > 1)
+        elif op is sre_parse.BRANCH:
+            if repeated:
+                raise ValueError("Regexes can't repeat alternatives, like `(a|b)+`.")
+            varying += max(_check_safe(item, repeated) for item in av[1])
+        elif op is sre_parse.SUBPATTERN:
+            varying += _check_safe(av[-1], repeated)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            varying += _check_safe(av[1], repeated)
+        elif op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            raise ValueError("Regexes can't use backreferences.")
+        elif getattr(sre_parse, "ATOMIC_GROUP", None) is not None and op is sre_parse.ATOMIC_GROUP:
+            varying += _check_safe(av, repeated)
+    return varying
+
+
+class SubstringMatcher:
+    """Aho-Corasick automaton, finds every substring in one pass over the text."""
+
+    def __init__(self, needles):
+        # Per state: transitions, failure link, and the hits ending there
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for text, hit in needles:
+            state = 0
+            for char in text:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = self.goto[state][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = next_state
+            self.out[state].append(hit)
+
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+    def find(self, text, found):
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+
+
+class TriggerIndex:
+    """The triggers of one guild, compiled from its reactions config.
+
+    Words are a dict lookup per distinct word in the message, stems a
+    lookup per prefix length, phrases a lookup on their first word.
+    Substrings are all found in one pass by an Aho-Corasick automaton.
+    Regexes are searched one by one, so each can fire, within a time
+    budget. Emojis come back in the order they appear in the config.
+
+    Everything is stored as (emoji, trigger) pairs, so callers can tell
+    which triggers fired as well as which emojis to react with.
+    """
+
+    def __init__(self, reactions):
+        # emoji string -> position in the config, to keep reactions ordered
+        self.order = {}
+        self.triggers = {}
+        self.stems = {}
+        # first word -> [(words, (emoji, trigger))]
+        self.phrases = {}
+        self.substrings = []
+        self.regexes = []
+        self.strikes = 0
+        self.paused_until = 0
+        self.count = 0
+        for emoji, triggers in reactions.items():
+            self.order[emoji] = len(self.order)
+            for trigger in triggers:
+                self._add(trigger, emoji)
+        self._stem_lengths = sorted({len(s) for s in self.stems})
+        self.automaton = SubstringMatcher(self.substrings) if self.substrings else None
+
+    def _add(self, trigger, emoji):
+        kind = trigger_kind(trigger)
+        hit = (emoji, trigger)
+        # Only possible if they were stored some other way than addreact
+        try:
+            validate_trigger(trigger)
+        except ValueError as e:
+            log.warning("Skipping trigger %r: %s", trigger, e)
+            return
+        if kind == REGEX:
+            if len(self.regexes) >= LIMITS[REGEX]:
+                log.warning("Skipping regex trigger %r, there are too many", trigger)
+                return
+            pattern = re.compile(trigger[len(REGEX_PREFIX):], flags=re.IGNORECASE)
+            self.regexes.append((pattern, hit))
+        elif kind == SUBSTRING:
+            if len(self.substrings) >= LIMITS[SUBSTRING]:
+                log.warning("Skipping substring trigger %r, there are too many", trigger)
+                return
+            self.substrings.append((trigger[1:-1].lower(), hit))
+        elif kind == STEM:
+            self.stems.setdefault(trigger[:-1].lower(), []).append(hit)
+        elif kind == PHRASE:
+            words = tuple(w.strip(PUNCTUATION) for w in trigger.lower().split())
+            self.phrases.setdefault(words[0], []).append((words, hit))
+        else:
+            self.triggers.setdefault(trigger.lower(), []).append(hit)
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def match(self, content):
+        """The stored emoji strings to react to `content` with."""
+        emojis = []
+        for emoji, _ in self.match_triggers(content):
+            if emoji not in emojis:
+                emojis.append(emoji)
+        return emojis
+
+    def match_triggers(self, content):
+        """The (emoji, trigger) pairs that `content` matches."""
+        content = content[:MAX_SCAN_LENGTH]
+        words = content.lower().split()
+        found = set()
+        distinct = set(words)
+        for word in distinct:
+            hits = self.triggers.get(word)
+            if hits:
+                found.update(hits)
+        if self.stems:
+            for word in distinct:
+                for length in self._stem_lengths:
+                    if length > len(word):
+                        break
+                    hits = self.stems.get(word[:length])
+                    if hits:
+                        found.update(hits)
+        if self.phrases:
+            stripped = [w.strip(PUNCTUATION) for w in words]
+            for i, word in enumerate(stripped):
+                for phrase, hit in self.phrases.get(word, ()):
+                    if tuple(stripped[i : i + len(phrase)]) == phrase:
+                        found.add(hit)
+        if self.automaton is not None:
+            self.automaton.find(content.lower(), found)
+        if self.regexes and self.paused_until < time.monotonic():
+            self._match_regexes(content, found)
+        if len(found) > 1:
+            return sorted(found, key=lambda hit: (self.order[hit[0]], hit[1]))
+        return list(found)
+
+    def _match_regexes(self, content, found):
+        content = content[:REGEX_SCAN_LENGTH]
+        start = time.perf_counter()
+        over_budget = False
+        for pattern, hit in self.regexes:
+            if hit not in found and pattern.search(content):
+                found.add(hit)
+            if time.perf_counter() - start > REGEX_BUDGET:
+                over_budget = True
+                break
+        if not over_budget:
+            self.strikes = 0
+            return
+        self.strikes += 1
+        if self.strikes >= REGEX_STRIKES:
+            log.warning(
+                "Regex triggers kept going over their time budget, "
+                "switching them off for %d seconds.",
+                REGEX_PAUSE,
+            )
+            self.strikes = 0
+            self.paused_until = time.monotonic() + REGEX_PAUSE
@@ -2,26 +2,69 @@ import asyncio
 import copy
 import discord
 import re
+from io import BytesIO
 
 from redbot.core import Config, commands, checks
-from redbot.core.utils.chat_formatting import pagify
+from redbot.core.utils.chat_formatting import box, pagify
 from redbot.core.utils.menus import start_adding_reactions
 from redbot.core.utils.predicates import ReactionPredicate
 
+from .dispatcher import ReactionDispatcher
+from .matcher import LIMITS, TriggerIndex, check_limits, normalize_trigger, trigger_kind, validate_trigger
+from .stats import TriggerStats, merge
+from .tables import build_table, export_csv, export_json, parse_csv, parse_json
+from .throttle import THROTTLE_DEFAULTS, Throttle
+
 
 EMOJI_RE = re.compile("(<a?)?:\\w+:(\\d{18,19}>)?")
 EMOJI_ID_RE = re.compile("\\d{18,19}")
+UNKNOWN_MESSAGE = 10008
+# Emoji changes tend to come in bursts, prune once they settle
+PRUNE_DELAY = 30
+STATS_FLUSH_INTERVAL = 300
+# Reaction changes from listeners are written this long after the first one
+WRITE_DELAY = 5
+MAX_IMPORT_SIZE = 2**20
 
 
 class SmartReact(commands.Cog):
     """Create automatic reactions when trigger words are typed in chat."""
 
-    default_guild_settings = {"reactions": {}}
+    default_guild_settings = {"reactions": {}, "stats": {}, **THROTTLE_DEFAULTS}
 
     def __init__(self, bot):
         self.bot = bot
         self.conf = Config.get_conf(self, identifier=964952632)
         self.conf.register_guild(**self.default_guild_settings)
+        # guild id -> reactions. This copy is the one that's changed, and
+        # Config catches up through _write_reactions.
+        self._reactions = {}
+        self._dirty = set()
+        self._write_lock = asyncio.Lock()
+        self._write_needed = asyncio.Event()
+        self._write_task = self.bot.loop.create_task(self._write_loop())
+        # guild id -> TriggerIndex, rebuilt whenever the reactions change
+        self._indexes = {}
+        # stored emoji string -> what fix_custom_emoji made of it, dropped
+        # whenever the emojis the bot can see change
+        self._emojis = {}
+        self._prune_needed = asyncio.Event()
+        self._prune_task = self.bot.loop.create_task(self._prune_loop())
+        self.dispatcher = ReactionDispatcher(self.bot.loop, self._react)
+        self.throttle = Throttle()
+        # guild id -> throttle settings, kept in step with Config by reactset
+        self._throttle_settings = {}
+        # Counted per message, written to Config every few minutes
+        self.stats = TriggerStats()
+        self._stats_task = self.bot.loop.create_task(self._stats_loop())
+
+    def cog_unload(self):
+        self._prune_task.cancel()
+        self._stats_task.cancel()
+        self._write_task.cancel()
+        self.dispatcher.close()
+        self.bot.loop.create_task(self._flush_stats())
+        self.bot.loop.create_task(self._write_reactions())
 
     async def red_delete_data_for_user(self, **kwargs):
         """Nothing to delete."""
@@ -36,7 +79,28 @@ class SmartReact(commands.Cog):
         Add an auto reaction to a word.
 
         The `emoji` can be either the emoji itself, or in the case of a custom emoji, the ID.
+
+        Besides single words, the trigger can be:
+        - a phrase in quotes, like `"good morning"`
+        - the start of a word, like `lol*` (matches "lolol")
+        - text anywhere in the message, like `*lol*`
+        - a regex, like `re:lo+l`, with some limits to keep it fast
         """
+        word = normalize_trigger(word)
+        try:
+            validate_trigger(word)
+        except ValueError as e:
+            return await ctx.send(str(e))
+        kind = trigger_kind(word)
+        if kind in LIMITS:
+            reactions = await self._get_reactions(ctx.guild)
+            count = sum(trigger_kind(t) == kind for words in reactions.values() for t in words)
+            if count >= LIMITS[kind]:
+                return await ctx.send(
+                    "This server already has {} {} triggers, the most it can have.".format(
+                        LIMITS[kind], kind
+                    )
+                )
         emoji = self.fix_custom_emoji(emoji)
         await self.create_smart_reaction(ctx.guild, word, emoji, ctx.message)
 
@@ -50,6 +114,7 @@ class SmartReact(commands.Cog):
 
         The `emoji` can be either the emoji itself, or in the case of a custom emoji, the ID.
         """
+        word = normalize_trigger(word)
         emoji = self.fix_custom_emoji(emoji)
         await self.remove_smart_reaction(ctx.guild, word, emoji, ctx.message)
 
@@ -68,7 +133,10 @@ class SmartReact(commands.Cog):
             return await ctx.send("Response timed out. Please run this command again if you wish to try again.")
 
         if pred.result is True:
-            await self.conf.guild(ctx.guild).clear()
+            (await self._get_reactions(ctx.guild)).clear()
+            self._reactions_changed(ctx.guild)
+            await self._write_reactions()
+            await self.conf.guild(ctx.guild).stats.clear()
             return await ctx.send("Done. All reactions for this server have been cleared.")
         else:
             return await ctx.send("Alright, I'm not clearing all reactions in this server.")
@@ -97,17 +165,177 @@ class SmartReact(commands.Cog):
         # or, nothing matched
         return None
 
+    @checks.mod_or_permissions(administrator=True)
+    @commands.guild_only()
+    @commands.group(invoke_without_command=True)
+    async def reactset(self, ctx):
+        """Throttle smart reactions in this server.
+
+        Shows the current settings and how many reactions they've held back."""
+        settings = await self._get_throttle_settings(ctx.guild)
+        suppressed = self.throttle.suppressed.get(ctx.guild.id, {})
+        msg = (
+            f"Cooldown per trigger: {settings['cooldown'] or 'off'}"
+            f"{' seconds' if settings['cooldown'] else ''}\n"
+            f"Reactions per channel per minute: {settings['channel_cap'] or 'no limit'}\n"
+            f"Chance to react: {settings['chance']}%\n\n"
+            f"Held back since the bot started:\n"
+            f"By cooldowns: {suppressed.get('cooldown', 0)}\n"
+            f"By channel limits: {suppressed.get('cap', 0)}\n"
+            f"By chance: {suppressed.get('chance', 0)}"
+        )
+        await ctx.send(box(msg, lang="ini"))
+
+    @reactset.command(name="cooldown")
+    async def reactset_cooldown(self, ctx, seconds: int):
+        """Set how long a trigger waits before firing again in a channel. 0 turns it off."""
+        if not 0 <= seconds <= 86400:
+            return await ctx.send("Cooldown must be between 0 and 86400 seconds.")
+        await self._set_throttle_setting(ctx.guild, "cooldown", seconds)
+        await ctx.send("Trigger cooldown set to {} seconds.".format(seconds))
+
+    @reactset.command(name="cap")
+    async def reactset_cap(self, ctx, per_minute: int):
+        """Set the most smart reactions a channel gets per minute. 0 means no limit."""
+        if per_minute < 0:
+            return await ctx.send("The limit can't be negative.")
+        await self._set_throttle_setting(ctx.guild, "channel_cap", per_minute)
+        await ctx.send("Channels will get at most {} smart reactions a minute.".format(per_minute))
+
+    @reactset.command(name="chance")
+    async def reactset_chance(self, ctx, percent: int):
+        """Set the chance, in percent, that a matched trigger gets its reaction."""
+        if not 1 <= percent <= 100:
+            return await ctx.send("Chance must be between 1 and 100 percent.")
+        await self._set_throttle_setting(ctx.guild, "chance", percent)
+        await ctx.send("Triggers will react {}% of the time.".format(percent))
+
+    async def _get_throttle_settings(self, guild):
+        settings = self._throttle_settings.get(guild.id)
+        if settings is None:
+            data = await self.conf.guild(guild).all()
+            settings = {name: data[name] for name in THROTTLE_DEFAULTS}
+            self._throttle_settings[guild.id] = settings
+        return settings
+
+    async def _set_throttle_setting(self, guild, name, value):
+        settings = await self._get_throttle_settings(guild)
+        await self.conf.guild(guild).set_raw(name, value=value)
+        settings[name] = value
+
+    @checks.mod_or_permissions(administrator=True)
+    @commands.guild_only()
+    @commands.command(name="reactexport")
+    async def reactexport(self, ctx, file_format: str = "json"):
+        """Export this server's smart reactions as a `json` or `csv` file."""
+        file_format = file_format.lower()
+        if file_format not in ("json", "csv"):
+            return await ctx.send("The format must be `json` or `csv`.")
+        reactions = await self._get_reactions(ctx.guild)
+        text = export_json(reactions) if file_format == "json" else export_csv(reactions)
+        data = BytesIO(text.encode("utf-8"))
+        await ctx.send(file=discord.File(data, filename=f"smartreact-{ctx.guild.id}.{file_format}"))
+
+    @checks.mod_or_permissions(administrator=True)
+    @commands.guild_only()
+    @commands.command(name="reactimport")
+    async def reactimport(self, ctx, replace: bool = False):
+        """Import smart reactions from an attached `json` or `csv` file.
+
+        Use the format `[p]reactexport` makes. The CSV has an emoji and a
+        trigger per line. The reactions are added to the existing ones, or
+        replace them all with `[p]reactimport yes`. Nothing is imported if
+        any line has a problem."""
+        attachments = ctx.message.attachments
+        if len(attachments) != 1:
+            return await ctx.send("Please attach one `.json` or `.csv` file.")
+        attachment = attachments[0]
+        extension = attachment.filename.rsplit(".", 1)[-1].lower()
+        if extension not in ("json", "csv"):
+            return await ctx.send("Please attach one `.json` or `.csv` file.")
+        if attachment.size > MAX_IMPORT_SIZE:
+            return await ctx.send("That file is too large, it can be up to 1 MiB.")
+        try:
+            text = (await attachment.read()).decode("utf-8-sig")
+            rows = parse_json(text) if extension == "json" else parse_csv(text)
+        except UnicodeDecodeError:
+            return await ctx.send("That file isn't UTF-8 text.")
+        except discord.HTTPException:
+            return await ctx.send("Downloading that file failed.")
+        except ValueError as e:
+            return await ctx.send(str(e))
+
+        imported, errors = build_table(rows, self.bot.get_emoji)
+        if errors:
+            msg = "Nothing was imported, please fix these first:\n" + "\n".join(errors)
+            for page in pagify(msg, delims=["\n"]):
+                await ctx.send(page, allowed_mentions=discord.AllowedMentions(users=False, everyone=False, roles=False))
+            return
+
+        reactions = await self._get_reactions(ctx.guild)
+        table = {} if replace else copy.deepcopy(reactions)
+        for emoji, triggers in imported.items():
+            existing = table.setdefault(emoji, [])
+            existing.extend(t for t in triggers if t not in existing)
+        try:
+            check_limits(table)
+        except ValueError as e:
+            return await ctx.send(str(e))
+
+        reactions.clear()
+        reactions.update(table)
+        self._reactions_changed(ctx.guild)
+        await self._write_reactions()
+        count = sum(len(triggers) for triggers in imported.values())
+        await ctx.send("Imported {} smart reactions.".format(count))
+
+    @checks.mod_or_permissions(administrator=True)
+    @commands.guild_only()
+    @commands.command(name="reactstats")
+    async def reactstats(self, ctx, top: int = 10):
+        """Show the triggers that fire most, and the ones that never have."""
+        reactions = await self._get_reactions(ctx.guild)
+        totals = merge(
+            await self.conf.guild(ctx.guild).stats(), self.stats.pending(ctx.guild.id), reactions
+        )
+        counted = [
+            (hits, placed, emoji, trigger)
+            for emoji, triggers in totals.items()
+            for trigger, (hits, placed) in triggers.items()
+            if hits
+        ]
+        counted.sort(key=lambda row: row[0], reverse=True)
+        unused = [
+            (emoji, trigger)
+            for emoji, triggers in reactions.items()
+            for trigger in triggers
+            if not totals.get(emoji, {}).get(trigger, [0])[0]
+        ]
+
+        msg = f"Most used smart reactions in {ctx.guild.name}:\n"
+        for hits, placed, emoji, trigger in counted[: max(top, 1)]:
+            msg += f"{emoji} {trigger}: {hits} hits, {placed} reactions\n"
+        if not counted:
+            msg += "None yet.\n"
+        msg += "\nNever used:\n"
+        for emoji, trigger in unused:
+            msg += f"{emoji} {trigger}\n"
+        if not unused:
+            msg += "None.\n"
+        for page in pagify(msg, delims=["\n"]):
+            await ctx.send(page, allowed_mentions=discord.AllowedMentions(users=False, everyone=False, roles=False))
+
     @checks.mod_or_permissions(administrator=True)
     @commands.guild_only()
     @commands.command(name="listreact")
     async def listreact(self, ctx):
         """List smart reactions for this server."""
-        emojis = await self.conf.guild(ctx.guild).reactions()
+        emojis = await self._get_reactions(ctx.guild)
         emojis_copy = copy.deepcopy(emojis)
         emojis_copy = {k: v for k, v in sorted(emojis_copy.items(), key=lambda item: item[1])}
         msg = f"Smart Reactions for {ctx.guild.name}:\n"
         for emoji, words in emojis_copy.items():
-            e = self.fix_custom_emoji(emoji)
+            e = self._resolve(emoji)
             if (not e) or (len(words) == 0):
                 del emojis[emoji]
                 continue
@@ -118,7 +346,9 @@ class SmartReact(commands.Cog):
                     msg += f"{emoji} `{custom_emoji_id}`: {command}\n"
                 else:
                     msg += f"{emoji} `Default emoji`: {command}\n"
-        await self.conf.guild(ctx.guild).reactions.set(emojis)
+        if len(emojis) != len(emojis_copy):
+            self._reactions_changed(ctx.guild)
+            await self._write_reactions()
         if len(emojis) == 0:
             msg += "None."
         for page in pagify(msg, delims=["\n"]):
@@ -129,15 +359,16 @@ class SmartReact(commands.Cog):
             # Use the reaction to see if it's valid
             await message.add_reaction(emoji)
             emoji = str(emoji)
-            reactions = await self.conf.guild(guild).reactions()
+            reactions = await self._get_reactions(guild)
             if emoji in reactions:
-                if word.lower() in reactions[emoji]:
+                if word in reactions[emoji]:
                     await message.channel.send("This smart reaction already exists.")
                     return
-                reactions[emoji].append(word.lower())
+                reactions[emoji].append(word)
             else:
-                reactions[emoji] = [word.lower()]
-            await self.conf.guild(guild).reactions.set(reactions)
+                reactions[emoji] = [word]
+            self._reactions_changed(guild)
+            await self._write_reactions()
             await message.channel.send("Successfully added this reaction.")
 
         except (discord.errors.HTTPException, discord.errors.InvalidArgument):
@@ -148,11 +379,12 @@ class SmartReact(commands.Cog):
             # Use the reaction to see if it's valid
             await message.add_reaction(emoji)
             emoji = str(emoji)
-            reactions = await self.conf.guild(guild).reactions()
+            reactions = await self._get_reactions(guild)
             if emoji in reactions:
-                if word.lower() in reactions[emoji]:
-                    reactions[emoji].remove(word.lower())
-                    await self.conf.guild(guild).reactions.set(reactions)
+                if word in reactions[emoji]:
+                    reactions[emoji].remove(word)
+                    self._reactions_changed(guild)
+                    await self._write_reactions()
                     await message.channel.send("Removed this smart reaction.")
                 else:
                     await message.channel.send("That emoji is not used as a reaction for that word.")
@@ -161,6 +393,47 @@ class SmartReact(commands.Cog):
         except (discord.errors.HTTPException, discord.errors.InvalidArgument):
             await message.channel.send("That's not an emoji I recognize. (might be custom!)")
 
+    async def _get_reactions(self, guild):
+        """The guild's reactions. Change them in place, then call _reactions_changed."""
+        reactions = self._reactions.get(guild.id)
+        if reactions is None:
+            data = await self.conf.guild(guild).reactions()
+            # Loaded by someone else while waiting on Config
+            reactions = self._reactions.setdefault(guild.id, data)
+        return reactions
+
+    def _reactions_changed(self, guild):
+        """Rebuild the guild's trigger index and queue its reactions to be saved.
+
+        Commands await _write_reactions afterwards, listeners leave it to the
+        background writer, which saves each changed guild once per WRITE_DELAY.
+        """
+        self._indexes[guild.id] = TriggerIndex(self._reactions[guild.id])
+        self._dirty.add(guild.id)
+        self._write_needed.set()
+
+    async def _write_loop(self):
+        while True:
+            await self._write_needed.wait()
+            await asyncio.sleep(WRITE_DELAY)
+            self._write_needed.clear()
+            await self._write_reactions()
+
+    async def _write_reactions(self):
+        async with self._write_lock:
+            dirty, self._dirty = self._dirty, set()
+            for guild_id in dirty:
+                # Copied, the dict keeps changing while Config writes
+                reactions = {e: list(words) for e, words in self._reactions[guild_id].items()}
+                await self.conf.guild(discord.Object(id=guild_id)).reactions.set(reactions)
+
+    async def _trigger_index(self, guild):
+        index = self._indexes.get(guild.id)
+        if index is None:
+            index = TriggerIndex(await self._get_reactions(guild))
+            self._indexes[guild.id] = index
+        return index
+
     # Thanks irdumb#1229 for the help making this "more Pythonic"
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -170,20 +443,132 @@ class SmartReact(commands.Cog):
             return
         if message.author.id == self.bot.user.id:
             return
-        reacts = copy.deepcopy(await self.conf.guild(message.guild).reactions())
-        if reacts is None:
+        index = await self._trigger_index(message.guild)
+        if not index:
             return
-        words = message.content.lower().split()
-        for emoji in reacts:
-            if set(w.lower() for w in reacts[emoji]).intersection(words):
-                emoji = self.fix_custom_emoji(emoji)
-                if not emoji:
-                    return
-                try:
-                    await message.add_reaction(emoji)
-                except (discord.errors.Forbidden, discord.errors.InvalidArgument, discord.errors.NotFound):
-                    pass
-                except discord.errors.HTTPException:
-                    if emoji in reacts:
-                        del reacts[emoji]
-                        await self.conf.guild(message.guild).reactions.set(reacts)
+        matched = index.match_triggers(message.content)
+        if not matched:
+            return
+        settings = await self._get_throttle_settings(message.guild)
+        emojis = set()
+        hits = []
+        for emoji, trigger in matched:
+            self.stats.hit(message.guild.id, emoji, trigger)
+            if emoji in emojis:
+                continue
+            if self.throttle.allow(message.guild.id, message.channel.id, trigger, settings):
+                emojis.add(emoji)
+                hits.append((emoji, trigger))
+        if hits:
+            self.dispatcher.submit(message, hits)
+
+    async def _react(self, message, stored, trigger):
+        """Add one reaction for the dispatcher. False gives up on the message."""
+        emoji = self._resolve(stored)
+        if not emoji:
+            # Left for the background pruning to remove
+            return True
+        try:
+            await message.add_reaction(emoji)
+            self.stats.reacted(message.guild.id, stored, trigger)
+        except discord.errors.Forbidden:
+            return False
+        except discord.errors.NotFound as e:
+            return e.code != UNKNOWN_MESSAGE
+        except discord.errors.InvalidArgument:
+            pass
+        except discord.errors.HTTPException:
+            reacts = await self._get_reactions(message.guild)
+            if stored in reacts:
+                del reacts[stored]
+                self._reactions_changed(message.guild)
+        return True
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        self.dispatcher.discard(payload.channel_id, payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:
+            self.dispatcher.discard(payload.channel_id, message_id)
+
+    def _resolve(self, stored):
+        """The emoji to react with for a stored emoji string, or None."""
+        try:
+            return self._emojis[stored]
+        except KeyError:
+            emoji = self._emojis[stored] = self.fix_custom_emoji(stored)
+            return emoji
+
+    def _emojis_changed(self, prune=True):
+        self._emojis.clear()
+        if prune:
+            self._prune_needed.set()
+
+    @commands.Cog.listener()
+    async def on_guild_emojis_update(self, guild, before, after):
+        self._emojis_changed()
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        self._emojis_changed()
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        # The bot may well be added back, don't throw its emojis' triggers away
+        self._emojis_changed(prune=False)
+
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild):
+        # Unresolved emojis may have been from this guild, and pruning may
+        # have been put off until it came back
+        self._emojis_changed()
+
+    @commands.Cog.listener()
+    async def on_guild_unavailable(self, guild):
+        self._emojis_changed(prune=False)
+
+    async def _prune_loop(self):
+        await self.bot.wait_until_red_ready()
+        while True:
+            await self._prune()
+            await self._prune_needed.wait()
+            await asyncio.sleep(PRUNE_DELAY)
+            self._prune_needed.clear()
+
+    async def _prune(self):
+        """Remove reactions whose emoji no longer resolves, in every guild.
+
+        Put off while any guild is unavailable, its emojis wouldn't resolve
+        either. on_guild_available asks again once it's back.
+        """
+        if any(guild.unavailable for guild in self.bot.guilds):
+            return
+        stored = {g for g, data in (await self.conf.all_guilds()).items() if data["reactions"]}
+        for guild_id in stored | set(self._reactions):
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                continue
+            reactions = await self._get_reactions(guild)
+            dead = [e for e, words in reactions.items() if not words or not self._resolve(e)]
+            if dead:
+                for emoji in dead:
+                    del reactions[emoji]
+                self._reactions_changed(guild)
+
+    async def _stats_loop(self):
+        await self.bot.wait_until_red_ready()
+        while True:
+            await asyncio.sleep(STATS_FLUSH_INTERVAL)
+            await self._flush_stats()
+
+    async def _flush_stats(self):
+        """Add the counts since the last flush to the totals in Config."""
+        for guild_id, counts in self.stats.take().items():
+            group = self.conf.guild(discord.Object(id=guild_id))
+            reactions = self._reactions.get(guild_id)
+            if reactions is None:
+                reactions = await group.reactions()
+            totals = merge(await group.stats(), counts, reactions)
+            await group.stats.set(totals)
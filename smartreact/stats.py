@@ -0,0 +1,43 @@
+class TriggerStats:
+    """Trigger hits and reactions placed, counted in memory between flushes.
+
+    `take` hands over what was counted since the last call, to be added
+    to the totals in Config, which are stored per guild as
+    {emoji: {trigger: [hits, reactions]}}.
+    """
+
+    def __init__(self):
+        # guild id -> {(emoji, trigger): [hits, reactions]}
+        self._pending = {}
+
+    def hit(self, guild_id, emoji, trigger):
+        self._counts(guild_id, emoji, trigger)[0] += 1
+
+    def reacted(self, guild_id, emoji, trigger):
+        self._counts(guild_id, emoji, trigger)[1] += 1
+
+    def _counts(self, guild_id, emoji, trigger):
+        guild = self._pending.setdefault(guild_id, {})
+        counts = guild.get((emoji, trigger))
+        if counts is None:
+            counts = guild[(emoji, trigger)] = [0, 0]
+        return counts
+
+    def pending(self, guild_id):
+        return self._pending.get(guild_id, {})
+
+    def take(self):
+        pending, self._pending = self._pending, {}
+        return pending
+
+
+def merge(totals, counts, reactions):
+    """Add `counts` to `totals`, keeping only triggers in `reactions`."""
+    merged = {}
+    for emoji, triggers in reactions.items():
+        for trigger in triggers:
+            hits, placed = totals.get(emoji, {}).get(trigger, (0, 0))
+            new_hits, new_placed = counts.get((emoji, trigger), (0, 0))
+            if hits or placed or new_hits or new_placed:
+                merged.setdefault(emoji, {})[trigger] = [hits + new_hits, placed + new_placed]
+    return merged
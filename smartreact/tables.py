@@ -0,0 +1,101 @@
+import csv
+import io
+import json
+import re
+
+from .matcher import normalize_trigger, validate_trigger
+
+CUSTOM_EMOJI_RE = re.compile(r"<(a?):(\w+):(\d{17,20})>")
+EMOJI_ID_RE = re.compile(r"\d{17,20}")
+CSV_HEADER = ["emoji", "trigger"]
+MAX_ERRORS = 10
+
+
+def export_json(reactions):
+    return json.dumps(reactions, indent=2, ensure_ascii=False)
+
+
+def export_csv(reactions):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(CSV_HEADER)
+    for emoji, triggers in reactions.items():
+        for trigger in triggers:
+            writer.writerow([emoji, trigger])
+    return out.getvalue()
+
+
+def parse_json(text):
+    """[(where, emoji, trigger)] from an exported JSON table."""
+    try:
+        data = json.loads(text)
+    except ValueError as e:
+        raise ValueError("That isn't valid JSON: {}.".format(e))
+    if not isinstance(data, dict):
+        raise ValueError("The JSON should be an object of emojis to lists of triggers.")
+    rows = []
+    for emoji, triggers in data.items():
+        if isinstance(triggers, str):
+            triggers = [triggers]
+        if not isinstance(triggers, list) or not all(isinstance(t, str) for t in triggers):
+            raise ValueError("The triggers for {} should be a list of text.".format(emoji))
+        rows.extend((emoji, emoji, trigger) for trigger in triggers)
+    return rows
+
+
+def parse_csv(text):
+    """[(where, emoji, trigger)] from an exported CSV table."""
+    rows = []
+    reader = csv.reader(io.StringIO(text))
+    for line, row in enumerate(reader, start=1):
+        if not row or (line == 1 and [c.strip().lower() for c in row] == CSV_HEADER):
+            continue
+        if len(row) != 2:
+            raise ValueError("Line {} should have two columns, emoji and trigger.".format(line))
+        rows.append((f"line {line}", row[0].strip(), row[1]))
+    return rows
+
+
+def build_table(rows, get_emoji):
+    """Validate every row at once, the way addreact checks emojis.
+
+    `get_emoji` looks up a custom emoji by ID, like `bot.get_emoji`, and
+    returns None for emojis the bot can't use. Returns
+    the reactions as they'd be stored, and a list of problems, at most
+    MAX_ERRORS of them plus a count of the rest.
+    """
+    reactions = {}
+    errors = []
+    for where, emoji, trigger in rows:
+        stored = _stored_emoji(emoji, get_emoji)
+        if stored is None:
+            errors.append(f"{where}: `{emoji}` isn't an emoji I can use.")
+            continue
+        trigger = normalize_trigger(trigger)
+        try:
+            if not trigger:
+                raise ValueError("The trigger is empty.")
+            validate_trigger(trigger)
+        except ValueError as e:
+            errors.append(f"{where}: {e}")
+            continue
+        triggers = reactions.setdefault(stored, [])
+        if trigger not in triggers:
+            triggers.append(trigger)
+    if len(errors) > MAX_ERRORS:
+        errors = errors[:MAX_ERRORS] + ["...and {} more.".format(len(errors) - MAX_ERRORS)]
+    return reactions, errors
+
+
+def _stored_emoji(emoji, get_emoji):
+    """The emoji as addreact would store it, or None."""
+    emoji = emoji.strip()
+    match = CUSTOM_EMOJI_RE.fullmatch(emoji) or EMOJI_ID_RE.fullmatch(emoji)
+    if match:
+        found = get_emoji(int(match[match.lastindex or 0]))
+        return str(found) if found else None
+    # Default emojis can't be checked without reacting with them, but
+    # they're short and never plain text
+    if not emoji or len(emoji) > 20 or emoji.isascii() or any(c.isspace() for c in emoji):
+        return None
+    return emoji
@@ -0,0 +1,64 @@
+import random
+import time
+
+THROTTLE_DEFAULTS = {"cooldown": 0, "channel_cap": 0, "chance": 100}
+# Cooldown entries are swept once there are this many, and after that once
+# there are twice as many as the last sweep left, so sweeps stay O(1)
+# amortized even when most entries are still live
+SWEEP_SIZE = 10000
+
+
+class Throttle:
+    """Decides, in memory, whether a matched trigger gets its reaction.
+
+    A trigger can't fire again in the same channel until `cooldown`
+    seconds have passed, a channel gets at most `channel_cap` reactions a
+    minute, and what passes both is let through `chance` percent of the
+    time. Zero turns the cooldown and cap off. Every check is a dict
+    lookup, and what gets suppressed is counted per guild.
+    """
+
+    def __init__(self):
+        # (channel id, trigger) -> when it may fire again
+        self._cooldowns = {}
+        # channel id -> [minute, reactions in that minute]
+        self._windows = {}
+        self._sweep_at = SWEEP_SIZE
+        # guild id -> {"cooldown": n, "cap": n, "chance": n}
+        self.suppressed = {}
+
+    def allow(self, guild_id, channel_id, trigger, settings):
+        now = time.monotonic()
+        key = (channel_id, trigger)
+        if settings["cooldown"] and self._cooldowns.get(key, 0) > now:
+            return self._suppress(guild_id, "cooldown")
+
+        if settings["channel_cap"]:
+            minute = int(now // 60)
+            window = self._windows.get(channel_id)
+            if window is None or window[0] != minute:
+                window = self._windows[channel_id] = [minute, 0]
+            if window[1] >= settings["channel_cap"]:
+                return self._suppress(guild_id, "cap")
+
+        if settings["chance"] < 100 and random.random() * 100 >= settings["chance"]:
+            return self._suppress(guild_id, "chance")
+
+        if settings["cooldown"]:
+            if len(self._cooldowns) >= self._sweep_at:
+                self._sweep(now)
+            self._cooldowns[key] = now + settings["cooldown"]
+        if settings["channel_cap"]:
+            window[1] += 1
+        return True
+
+    def _suppress(self, guild_id, reason):
+        counts = self.suppressed.setdefault(guild_id, {"cooldown": 0, "cap": 0, "chance": 0})
+        counts[reason] += 1
+        return False
+
+    def _sweep(self, now):
+        self._cooldowns = {k: until for k, until in self._cooldowns.items() if until > now}
+        minute = int(now // 60)
+        self._windows = {k: w for k, w in self._windows.items() if w[0] == minute}
+        self._sweep_at = max(SWEEP_SIZE, 2 * len(self._cooldowns))
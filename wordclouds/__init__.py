@@ -1,7 +1,7 @@
 from .wordclouds import WordClouds
 
 __red_end_user_data_statement__ = (
-    "This cog does not persistently store data or metadata about users."
+    "This cog stores word counts of messages in channels where indexing has been turned on, along with the Discord IDs of the message authors."
 )
 
 
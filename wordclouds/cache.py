@@ -0,0 +1,141 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+from wordcloud import ImageColorGenerator
+
+from .ingest import MASK_SUFFIX, binary_mask
+
+
+class MaskCache:
+    """Decoded mask arrays, keyed by filename and invalidated by mtime.
+
+    The precomputed binary mask saved at upload time is used when there is
+    one, and made the same way from the image when there isn't, so only
+    color masking needs the image's colors. Least
+    recently used masks are evicted once the arrays add up to more than
+    `max_bytes`. Loading blocks, so call `get` in an executor.
+    """
+
+    def __init__(self, folder, max_bytes=128 * 2**20):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, filename, colormask=False):
+        """Return (mask, color generator or None) for a mask file.
+
+        Raises FileNotFoundError if the file is gone.
+        """
+        path = f"{self.folder}/{filename}"
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry["mtime"] == mtime:
+                self.hits += 1
+                self._entries.move_to_end(filename)
+            else:
+                entry = None
+        if entry is None:
+            self.misses += 1
+            mask = self._load_mask(path, mtime)
+            entry = {
+                "mtime": mtime,
+                "mask": mask,
+                "coloring": None,
+                "bytes": mask.nbytes,
+            }
+            self._store(filename, entry)
+        if colormask and entry["coloring"] is None:
+            # The binary mask has no colors, decode the image itself
+            image = np.array(Image.open(path))
+            entry = dict(entry, bytes=entry["bytes"] + image.nbytes)
+            entry["coloring"] = ImageColorGenerator(image)
+            self._store(filename, entry)
+        return entry["mask"], entry["coloring"] if colormask else None
+
+    @staticmethod
+    def _load_mask(path, mtime):
+        precomputed = path + MASK_SUFFIX
+        try:
+            if os.stat(precomputed).st_mtime_ns >= mtime:
+                return np.load(precomputed)
+        except FileNotFoundError:
+            pass
+        # Put in place by hand, or replaced since the mask was precomputed.
+        # Same mask as upload would have saved, transparency included.
+        with Image.open(path) as image:
+            return binary_mask(image)
+
+    def _store(self, filename, entry):
+        with self._lock:
+            old = self._entries.pop(filename, None)
+            if old is not None:
+                self.bytes -= old["bytes"]
+            self._entries[filename] = entry
+            self.bytes += entry["bytes"]
+            # Always keep the newest entry, even if it's over the limit alone
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted["bytes"]
+
+    def discard(self, filename):
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is not None:
+                self.bytes -= entry["bytes"]
+
+
+class ResultCache:
+    """Rendered images keyed by a fingerprint of everything that went into them.
+
+    Entries expire after `ttl` seconds, and the oldest are evicted once the
+    stored images add up to more than `max_bytes`.
+    """
+
+    def __init__(self, ttl=600, max_bytes=32 * 2**20):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def fingerprint(*parts):
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """Return (filename, data) for a fingerprint, or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, filename, data = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return filename, data
+
+    def put(self, key, filename, data):
+        if len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, filename, data)
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, _, data = self._entries.pop(key)
+        self.bytes -= len(data)
@@ -0,0 +1,100 @@
+from array import array
+
+import numpy as np
+
+from .text import message_words
+
+
+class DistinctiveCounter:
+    """Finds the words that set one user apart from the rest of a channel.
+
+    A single pass over history counts both the user's words and everyone's
+    words against one shared vocabulary index. Word indices are buffered
+    and folded into NumPy count arrays with bincount a chunk at a time, so
+    memory is proportional to the vocabulary, not the history.
+
+    Words are scored with the log-odds ratio with an informative Dirichlet
+    prior (Monroe, Colaresi & Quinn, "Fightin' Words"), comparing the user
+    with everyone else and using the whole channel as the prior. `counts`
+    gives the z-scores of the words the user uses more than expected.
+    """
+
+    def __init__(self, stopwords=(), prior_size=500, chunk=65536):
+        self.stopwords = {w.lower() for w in stopwords}
+        self.prior_size = prior_size
+        self.chunk = chunk
+        self.vocabulary = {}
+        self.words = []
+        self._mine = np.zeros(0)
+        self._everyone = np.zeros(0)
+        self._pending_mine = array("q")
+        self._pending_everyone = array("q")
+
+    def _index(self, word):
+        index = self.vocabulary.get(word)
+        if index is None:
+            index = self.vocabulary[word] = len(self.words)
+            self.words.append(word)
+        return index
+
+    def feed(self, text, mine):
+        """Count a message, `mine` being whether the user wrote it."""
+        indices = [self._index(word.lower()) for word in message_words(text, self.stopwords)]
+        self._pending_everyone.extend(indices)
+        if mine:
+            self._pending_mine.extend(indices)
+        if len(self._pending_everyone) >= self.chunk:
+            self._flush()
+
+    def update(self, mine, everyone):
+        """Add precomputed frequencies, like the ones from the word index."""
+        self._flush()
+        for frequencies, attr in ((mine, "_mine"), (everyone, "_everyone")):
+            folded = {}
+            for word, count in frequencies.items():
+                word = word.lower()
+                if word not in self.stopwords:
+                    folded[word] = folded.get(word, 0) + count
+            frequencies = folded
+            indices = np.fromiter((self._index(w) for w in frequencies), dtype=np.int64)
+            weights = np.fromiter(frequencies.values(), dtype=np.float64)
+            counts = np.bincount(indices, weights=weights, minlength=len(self.words))
+            setattr(self, attr, self._grown(getattr(self, attr)) + counts)
+
+    def _grown(self, counts):
+        if len(counts) < len(self.words):
+            counts = np.concatenate([counts, np.zeros(len(self.words) - len(counts))])
+        return counts
+
+    def _flush(self):
+        size = len(self.words)
+        for pending, attr in ((self._pending_mine, "_mine"), (self._pending_everyone, "_everyone")):
+            counts = self._grown(getattr(self, attr))
+            if pending:
+                counts += np.bincount(np.frombuffer(pending, dtype=np.int64), minlength=size)
+            setattr(self, attr, counts)
+        self._pending_mine = array("q")
+        self._pending_everyone = array("q")
+
+    @property
+    def counts(self):
+        self._flush()
+        mine = self._mine
+        others = self._everyone - mine
+        n_mine = mine.sum()
+        n_others = others.sum()
+        if not n_mine:
+            return {}
+        if not n_others:
+            # Nobody to compare against
+            return {self.words[i]: float(mine[i]) for i in np.flatnonzero(mine)}
+
+        prior = self._everyone * (self.prior_size / self._everyone.sum())
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta = np.log((mine + prior) / (n_mine + self.prior_size - mine - prior)) - np.log(
+                (others + prior) / (n_others + self.prior_size - others - prior)
+            )
+            variance = 1 / (mine + prior) + 1 / (others + prior)
+            scores = delta / np.sqrt(variance)
+        keep = (mine > 0) & np.isfinite(scores) & (scores > 0)
+        return {self.words[i]: float(scores[i]) for i in np.flatnonzero(keep)}
@@ -0,0 +1,65 @@
+import time
+from io import BytesIO
+
+from wordcloud import WordCloud as WCloud
+
+FORMATS = {"png": "PNG", "webp": "WEBP", "jpeg": "JPEG"}
+EXTENSIONS = {"png": "png", "webp": "webp", "jpeg": "jpg"}
+# Smallest side we'll shrink an image to while trying to fit the upload limit
+MIN_SIDE = 200
+
+
+def encode(image, output_format="png", quality=90):
+    """Encode a PIL image into a named BytesIO ready for discord.File."""
+    if output_format == "jpeg" and image.mode == "RGBA":
+        # No alpha channel in JPEG
+        image = image.convert("RGB")
+    options = {} if output_format == "png" else {"quality": quality}
+    file = BytesIO()
+    image.save(file, FORMATS[output_format], **options)
+    file.name = f"wordcloud.{EXTENSIONS[output_format]}"
+    file.seek(0)
+    return file
+
+
+def encode_to_fit(image, output_format="png", quality=90, size_limit=None):
+    """Encode an image, re-encoding as needed to get under size_limit bytes.
+
+    Lower WebP quality is tried first, since WebP keeps transparency, then
+    the image is shrunk by a quarter at a time. Returns the smallest attempt
+    if nothing fits.
+    """
+    file = encode(image, output_format, quality)
+    if size_limit is None or file.getbuffer().nbytes <= size_limit:
+        return file
+    best = file
+    for fallback_quality in (min(quality, 80), 60, 40):
+        file = encode(image, "webp", fallback_quality)
+        if file.getbuffer().nbytes < best.getbuffer().nbytes:
+            best = file
+        if file.getbuffer().nbytes <= size_limit:
+            return file
+    while min(image.size) * 3 // 4 >= MIN_SIDE:
+        image = image.resize((image.width * 3 // 4, image.height * 3 // 4))
+        file = encode(image, "webp", 60)
+        if file.getbuffer().nbytes < best.getbuffer().nbytes:
+            best = file
+        if file.getbuffer().nbytes <= size_limit:
+            return file
+    return best
+
+
+def generate(frequencies, output_format="png", quality=90, size_limit=None, **kwargs):
+    """Lay out and encode a wordcloud.
+
+    Returns the encoded file and a dict of seconds spent per stage.
+    Designed to be run in a renderer process to avoid blocking.
+    """
+    start = time.perf_counter()
+    wc = WCloud(**kwargs)
+    wc.generate_from_frequencies(frequencies)
+    image = wc.to_image()
+    layout = time.perf_counter() - start
+    start = time.perf_counter()
+    file = encode_to_fit(image, output_format, quality, size_limit)
+    return file, {"layout": layout, "encode": time.perf_counter() - start}
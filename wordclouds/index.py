@@ -0,0 +1,147 @@
+import sqlite3
+import threading
+from collections import Counter
+
+
+class WordIndex:
+    """On-disk word counts per message, queryable by channel, author and window.
+
+    Every method here blocks on disk I/O, so the cog calls them in an executor.
+    Counts are stored per message so deletes and edits can simply replace the
+    rows of a single message instead of decrementing a running total.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id INTEGER PRIMARY KEY,
+                    guild_id INTEGER NOT NULL,
+                    channel_id INTEGER NOT NULL,
+                    author_id INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS messages_channel
+                    ON messages (channel_id, message_id);
+                CREATE INDEX IF NOT EXISTS messages_author
+                    ON messages (author_id);
+                CREATE TABLE IF NOT EXISTS words (
+                    message_id INTEGER NOT NULL,
+                    word TEXT NOT NULL,
+                    count INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS words_message
+                    ON words (message_id);
+                """
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def apply(self, ops):
+        """Apply a batch of queued operations in a single transaction.
+
+        Each op is a tuple of:
+        - ("add", guild_id, channel_id, author_id, message_id, counts)
+        - ("edit", message_id, counts)
+        - ("delete", message_id)
+        """
+        with self._lock, self._db:
+            for op in ops:
+                if op[0] == "add":
+                    _, guild_id, channel_id, author_id, message_id, counts = op
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                        (message_id, guild_id, channel_id, author_id),
+                    )
+                    self._replace_words(message_id, counts)
+                elif op[0] == "edit":
+                    _, message_id, counts = op
+                    exists = self._db.execute(
+                        "SELECT 1 FROM messages WHERE message_id = ?", (message_id,)
+                    ).fetchone()
+                    if exists:
+                        self._replace_words(message_id, counts)
+                elif op[0] == "delete":
+                    self._delete_messages([op[1]])
+
+    def _replace_words(self, message_id, counts):
+        self._db.execute("DELETE FROM words WHERE message_id = ?", (message_id,))
+        self._db.executemany(
+            "INSERT INTO words VALUES (?, ?, ?)",
+            ((message_id, word, count) for word, count in counts.items()),
+        )
+
+    def _delete_messages(self, message_ids):
+        rows = [(m,) for m in message_ids]
+        self._db.executemany("DELETE FROM words WHERE message_id = ?", rows)
+        self._db.executemany("DELETE FROM messages WHERE message_id = ?", rows)
+
+    def frequencies(self, channel_id, author_id=None, limit=None, after=None, before=None):
+        """Return a Counter of word frequencies for a channel.
+
+        `limit` restricts the window to the newest N indexed messages, and
+        `after`/`before` are exclusive message id (snowflake) bounds, so a
+        date range is just a pair of snowflakes. The author filter is applied
+        inside the window, like filtering channel history by author.
+        """
+        window = "SELECT message_id, author_id FROM messages WHERE channel_id = ?"
+        params = [channel_id]
+        if after is not None:
+            window += " AND message_id > ?"
+            params.append(after)
+        if before is not None:
+            window += " AND message_id < ?"
+            params.append(before)
+        window += " ORDER BY message_id DESC"
+        if limit is not None:
+            window += " LIMIT ?"
+            params.append(limit)
+
+        query = (
+            f"SELECT w.word, SUM(w.count) FROM ({window}) m "
+            "JOIN words w ON w.message_id = m.message_id"
+        )
+        if author_id is not None:
+            query += " WHERE m.author_id = ?"
+            params.append(author_id)
+        query += " GROUP BY w.word"
+
+        with self._lock:
+            return Counter(dict(self._db.execute(query, params)))
+
+    def newest_message_id(self, channel_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MAX(message_id) FROM messages WHERE channel_id = ?", (channel_id,)
+            ).fetchone()
+        return row[0]
+
+    def message_count(self, channel_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COUNT(*) FROM messages WHERE channel_id = ?", (channel_id,)
+            ).fetchone()
+        return row[0]
+
+    def clear_channel(self, channel_id):
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM words WHERE message_id IN "
+                "(SELECT message_id FROM messages WHERE channel_id = ?)",
+                (channel_id,),
+            )
+            self._db.execute("DELETE FROM messages WHERE channel_id = ?", (channel_id,))
+
+    def delete_author(self, author_id):
+        with self._lock, self._db:
+            message_ids = [
+                row[0]
+                for row in self._db.execute(
+                    "SELECT message_id FROM messages WHERE author_id = ?", (author_id,)
+                )
+            ]
+            self._delete_messages(message_ids)
@@ -0,0 +1,87 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+MAX_DOWNLOAD = 8 * 2**20
+CHUNK_SIZE = 64 * 1024
+ALLOWED_FORMATS = {"PNG", "JPEG", "GIF", "BMP", "WEBP"}
+# Precomputed masks are stored next to the image as <mask name> + this
+MASK_SUFFIX = ".npy"
+
+
+class MaskError(Exception):
+    """A mask was rejected. The message is meant for the user."""
+
+
+def is_mask_file(filename):
+    """Whether a file in the mask folder is a mask, not a helper file."""
+    return not filename.startswith(".") and not filename.endswith(MASK_SUFFIX)
+
+
+async def download(session, url, path, loop, max_bytes=MAX_DOWNLOAD):
+    """Stream a URL to disk without holding it in memory or blocking the loop.
+
+    Rejects it up front when the server announces more than `max_bytes`,
+    and aborts if more than that arrives anyway.
+    """
+    async with session.get(url) as response:
+        if response.status != 200:
+            raise MaskError("Downloading that failed (HTTP {}).".format(response.status))
+        if response.content_length and response.content_length > max_bytes:
+            raise MaskError(too_large(max_bytes))
+        file = await loop.run_in_executor(None, open, path, "wb")
+        try:
+            received = 0
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                received += len(chunk)
+                if received > max_bytes:
+                    raise MaskError(too_large(max_bytes))
+                await loop.run_in_executor(None, file.write, chunk)
+        finally:
+            await loop.run_in_executor(None, file.close)
+
+
+def too_large(max_bytes):
+    return "That image is too large, masks can be up to {} MiB.".format(max_bytes // 2**20)
+
+
+def prepare(source, destination, max_side):
+    """Validate, downscale and store a mask, with its precomputed binary mask.
+
+    Blocks, so run it in an executor. `source` is removed either way.
+    """
+    try:
+        try:
+            with Image.open(source) as image:
+                image.verify()
+            # verify() leaves the image unusable, so open it again
+            image = Image.open(source)
+            image.load()
+        except (OSError, SyntaxError, Image.DecompressionBombError):
+            raise MaskError("That doesn't look like an image I can use.")
+        if image.format not in ALLOWED_FORMATS:
+            raise MaskError(
+                "Masks must be one of: {}.".format(", ".join(sorted(ALLOWED_FORMATS)))
+            )
+        image_format = image.format
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side))
+        image.save(destination, image_format)
+        np.save(destination + MASK_SUFFIX, binary_mask(image))
+    finally:
+        try:
+            os.remove(source)
+        except FileNotFoundError:
+            pass
+
+
+def binary_mask(image):
+    """The mask as WordCloud reads it: 255 where no words go, 0 elsewhere.
+
+    Fully transparent pixels are masked out too, where WordCloud would
+    otherwise see the (often black) color underneath them.
+    """
+    rgba = np.asarray(image.convert("RGBA"))
+    masked = np.all(rgba[..., :3] == 255, axis=-1) | (rgba[..., 3] == 0)
+    return np.where(masked, 255, 0).astype(np.uint8)
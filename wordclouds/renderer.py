@@ -0,0 +1,226 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import signal
+import site
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+log = logging.getLogger("red.flapjackcogs.wordclouds")
+
+# Workers are spawned on every platform, forking a process full of threads
+# isn't safe. A spawned worker imports the render function by name, and Red
+# loads cogs from folders that aren't on sys.path, so it adds ours first.
+_CONTEXT = multiprocessing.get_context("spawn")
+_COG_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _executor():
+    return ProcessPoolExecutor(
+        max_workers=1, mp_context=_CONTEXT, initializer=site.addsitedir, initargs=(_COG_PARENT,)
+    )
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+class RenderJob:
+    def __init__(self, loop, guild_id, func):
+        self.guild_id = guild_id
+        self.func = func
+        self.started = loop.create_future()
+        self.future = loop.create_future()
+
+
+class _Slot:
+    """One worker process. Killing it is the only way to stop a running render."""
+
+    def __init__(self):
+        self.executor = _executor()
+        # The worker process, asked for before its first job
+        self.pid = None
+        self.job = None
+        self.retired = False
+
+    def kill(self):
+        pid = self.pid
+        executor = self.reset()
+        # ProcessPoolExecutor can't cancel a running call, so end the process
+        if pid is not None:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        executor.shutdown(wait=False)
+
+    def reset(self):
+        """Swap in a new executor, returning the old one."""
+        executor, self.executor = self.executor, _executor()
+        self.pid = None
+        return executor
+
+
+class Renderer:
+    """Runs wordcloud renders in dedicated worker processes.
+
+    Jobs wait in per-guild queues that are served round-robin, so a guild
+    queueing several clouds can't push everyone else to the back. The total
+    number of waiting jobs is bounded; submit raises RenderQueueFull past that.
+    """
+
+    def __init__(self, loop, workers=2, max_queued=20):
+        self.loop = loop
+        self.max_queued = max_queued
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._ready = asyncio.Semaphore(0)
+        self._slots = []
+        self._tasks = []
+        self.set_workers(workers)
+
+    @property
+    def workers(self):
+        return sum(1 for slot in self._slots if not slot.retired)
+
+    def set_workers(self, count):
+        active = [slot for slot in self._slots if not slot.retired]
+        for slot in active[count:]:
+            # Finish the current job, then exit
+            slot.retired = True
+            self._ready.release()
+        for _ in range(count - len(active)):
+            slot = _Slot()
+            self._slots.append(slot)
+            self._tasks.append(self.loop.create_task(self._work(slot)))
+
+    def submit(self, guild_id, func, *args, **kwargs):
+        if self._queued >= self.max_queued:
+            raise RenderQueueFull()
+        job = RenderJob(self.loop, guild_id, functools.partial(func, *args, **kwargs))
+        self._queues.setdefault(guild_id, deque()).append(job)
+        self._queued += 1
+        self._ready.release()
+        return job
+
+    def position(self, job):
+        """Place of a job in line, starting at 1. 0 means it isn't waiting,
+        or an idle worker is about to pick it up."""
+        queue = self._queues.get(job.guild_id)
+        if not queue or job not in queue:
+            return 0
+        rounds = queue.index(job)
+        ahead = 0
+        before = True
+        for guild_id, other in self._queues.items():
+            if guild_id == job.guild_id:
+                before = False
+                ahead += rounds
+            else:
+                # Guilds earlier in the rotation also get served in the job's round
+                ahead += min(len(other), rounds + 1 if before else rounds)
+        # Idle workers take jobs on the next loop iteration, they're not ahead
+        idle = sum(1 for slot in self._slots if slot.job is None and not slot.retired)
+        return max(ahead + 1 - idle, 0)
+
+    async def result(self, job, timeout):
+        """Wait for a job, timing out `timeout` seconds after it starts.
+
+        The job is cancelled, killing its process if need be, when this times
+        out or is itself cancelled.
+        """
+        try:
+            await job.started
+            return await asyncio.wait_for(asyncio.shield(job.future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self.cancel(job)
+            raise
+
+    def cancel(self, job):
+        queue = self._queues.get(job.guild_id)
+        if queue and job in queue:
+            queue.remove(job)
+            self._queued -= 1
+            if not queue:
+                del self._queues[job.guild_id]
+        else:
+            for slot in self._slots:
+                if slot.job is job:
+                    slot.kill()
+        job.started.cancel()
+        job.future.cancel()
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for queue in self._queues.values():
+            for job in queue:
+                job.started.cancel()
+                job.future.cancel()
+        self._queues.clear()
+        self._queued = 0
+        for slot in self._slots:
+            slot.kill()
+            slot.executor.shutdown(wait=False)
+
+    def _next_job(self):
+        if not self._queues:
+            return None
+        guild_id, queue = self._queues.popitem(last=False)
+        job = queue.popleft()
+        if queue:
+            # Back of the rotation
+            self._queues[guild_id] = queue
+        self._queued -= 1
+        return job
+
+    async def _work(self, slot):
+        while True:
+            await self._ready.acquire()
+            if slot.retired:
+                slot.executor.shutdown(wait=False)
+                self._slots.remove(slot)
+                # The token may have been meant for a queued job
+                self._ready.release()
+                return
+            job = self._next_job()
+            if job is None:
+                # Its job was cancelled while queued
+                continue
+            slot.job = job
+            try:
+                executor = slot.executor
+                if slot.pid is None:
+                    pid = await self.loop.run_in_executor(executor, os.getpid)
+                    # Unless the slot was killed, and got a new process, meanwhile
+                    if slot.executor is executor:
+                        slot.pid = pid
+                if job.future.done():
+                    # Cancelled while the worker was starting
+                    continue
+                job.started.set_result(None)
+                executor = slot.executor
+                result = await self.loop.run_in_executor(executor, job.func)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except BrokenProcessPool as e:
+                # The process died, killed by us or by something like the
+                # OOM killer. Every later call would fail the same way.
+                if slot.executor is executor:
+                    log.warning("Wordcloud worker process died, starting a new one")
+                    slot.reset().shutdown(wait=False)
+                if not job.future.done():
+                    job.future.set_exception(e)
+            except Exception as e:
+                if not job.future.done():
+                    log.exception("Wordcloud render failed", exc_info=e)
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                slot.job = None
@@ -0,0 +1,107 @@
+from PIL import ImageColor
+
+from .image import FORMATS
+
+DEFAULTS = {
+    "bgcolor": "black",
+    "maxwords": 200,
+    "excluded": [],
+    "mask": None,
+    "colormask": False,
+    "indexed_channels": [],
+    "width": 800,
+    "height": 600,
+    "scale": 1.0,
+    "output_format": "png",
+    "quality": 90,
+}
+
+MAX_WORDS = 4000
+MIN_SIDE = 100
+MAX_SIDE = 4000
+# Largest image drawn, after scaling, a 4000x4000 cloud at scale 1
+MAX_PIXELS = 16000000
+
+
+class GuildSettings:
+    """In-memory copy of a guild's WordClouds settings.
+
+    Built once from `conf.guild(guild).all()` and updated alongside Config by
+    the wcset commands, so generating a cloud never has to touch Config.
+    Values are checked by the validators below before they get here.
+    """
+
+    def __init__(self, **data):
+        for name, default in DEFAULTS.items():
+            value = data.get(name, default)
+            # Copy lists so the cache never shares them with Config
+            setattr(self, name, list(value) if isinstance(value, list) else value)
+
+    @property
+    def max_words(self):
+        return self.maxwords or DEFAULTS["maxwords"]
+
+    @property
+    def background(self):
+        """(background_color, image mode) as WordCloud takes them."""
+        if self.bgcolor == "clear":
+            return None, "RGBA"
+        return self.bgcolor, "RGB"
+
+
+# Validators raise ValueError with a message that can be shown to the user
+
+
+def validate_color(color):
+    if color.lower() == "clear":
+        return "clear"
+    try:
+        ImageColor.getrgb(color)
+    except ValueError:
+        raise ValueError(
+            "I don't know the color `{}`. Use a color name, a hex code like "
+            "`#ff8800`, or `clear` for transparent.".format(color)
+        )
+    return color
+
+
+def validate_maxwords(count):
+    if not 0 <= count <= MAX_WORDS:
+        raise ValueError("Max words must be between 0 and {}.".format(MAX_WORDS))
+    return count
+
+
+def validate_size(width, height):
+    if not (MIN_SIDE <= width <= MAX_SIDE and MIN_SIDE <= height <= MAX_SIDE):
+        raise ValueError("Width and height must be between {} and {}.".format(MIN_SIDE, MAX_SIDE))
+    return width, height
+
+
+def validate_scale(scale):
+    if not 0.1 <= scale <= 4:
+        raise ValueError("Scale must be between 0.1 and 4.")
+    return scale
+
+
+def validate_pixels(width, height, scale):
+    if width * height * scale ** 2 > MAX_PIXELS:
+        raise ValueError(
+            "That would draw {:.0f}x{:.0f} images, they can be up to {} million "
+            "pixels. Lower the size or the scale.".format(
+                width * scale, height * scale, MAX_PIXELS // 1000000
+            )
+        )
+
+
+def fit_scale(width, height, scale):
+    """The scale, lowered if need be to keep the image within MAX_PIXELS."""
+    return min(scale, (MAX_PIXELS / (width * height)) ** 0.5)
+
+
+def validate_format(output_format, quality):
+    output_format = output_format.lower().replace("jpg", "jpeg")
+    if output_format not in FORMATS:
+        raise ValueError("Format must be one of: {}.".format(", ".join(FORMATS)))
+    if not 1 <= quality <= 100:
+        raise ValueError("Quality must be between 1 and 100.")
+    return output_format, quality
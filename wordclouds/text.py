@@ -0,0 +1,200 @@
+import heapq
+import re
+from collections import Counter
+
+# Discord markup: user/role/channel mentions, custom emoji and timestamps.
+# Every alternative starts with a literal and no quantified class can also
+# match the character after it, so this can't backtrack.
+MARKUP_RE = re.compile(r"<(?:@[!&]?\d+|#\d+|a?:\w+:\d+|t:-?\d+(?::[a-zA-Z])?)>")
+# Dropped from the ends of a token before deciding if it's a link
+LINK_PUNCTUATION = "()[]{}<>.,;:!?'\"*_~`|"
+
+# Same word pattern WordCloud.process_text uses. With fold_words applied to
+# the totals, counts match what process_text gives with collocations off.
+# Two word collocations aren't looked for, the phrases option covers that.
+WORD_RE = re.compile(r"\w[\w']*")
+
+
+def tokenize(text):
+    """Yield words from text as written, dropping possessive 's and numbers."""
+    for word in WORD_RE.findall(text):
+        if word[-2:].lower() == "'s":
+            word = word[:-2]
+        if not word.isdigit():
+            yield word
+
+
+def count_words(text):
+    """Return a Counter of the words in text, without links or markup."""
+    return Counter(tokenize(strip_urls(text)))
+
+
+def fold_words(counts):
+    """Merge case variants and plurals of words, like WordCloud.process_text.
+
+    "Cats" and "cats" are one word, shown the way it's most often written,
+    and "pythons" counts as "python" when "python" was seen too.
+    """
+    variants = {}
+    for word, count in counts.items():
+        cases = variants.setdefault(word.lower(), {})
+        cases[word] = cases.get(word, 0) + count
+    for word in list(variants):
+        if word.endswith("s") and not word.endswith("ss") and word[:-1] in variants:
+            singular = variants[word[:-1]]
+            for plural, count in variants.pop(word).items():
+                singular[plural[:-1]] = singular.get(plural[:-1], 0) + count
+    return {
+        max(cases.items(), key=lambda item: item[1])[0]: sum(cases.values())
+        for cases in variants.values()
+    }
+
+
+def strip_urls(text):
+    """Remove links, mentions, custom emoji and timestamps from text.
+
+    Runs in linear time: one regex pass for Discord markup, then a scan
+    over whitespace-separated tokens for links.
+    """
+    text = MARKUP_RE.sub(" ", text)
+    if "." not in text and ":" not in text:
+        # Every link needs one or the other
+        return text
+    return " ".join(token for token in text.split() if not is_link(token))
+
+
+def is_link(token):
+    """Whether a whitespace-free token looks like a URL or bare domain."""
+    token = token.strip(LINK_PUNCTUATION)
+    if "://" in token or token[:4].lower() == "www.":
+        return True
+    host = token
+    for separator in "/?#":
+        host = host.partition(separator)[0]
+    host, _, port = host.partition(":")
+    if port and not port.isdigit():
+        return False
+    labels = host.split(".")
+    if len(labels) < 2:
+        return False
+    for label in labels:
+        if not label or not label.replace("-", "").replace("_", "").isalnum():
+            return False
+    # Top level domains are letters only, which keeps "3.14" and "v1.2" as text
+    return len(labels[-1]) >= 2 and labels[-1].isalpha()
+
+
+def message_words(text, stopwords):
+    """Words of a single message, minus links, markup and stopwords.
+
+    `stopwords` must be lowercase, words are compared ignoring case.
+    """
+    for word in tokenize(strip_urls(text)):
+        if word.lower() not in stopwords:
+            yield word
+
+
+class WordCounter:
+    """Accumulates word frequencies as messages stream in.
+
+    Memory is proportional to the vocabulary seen, not to the amount of
+    text fed, so it's safe to feed it an entire channel history. Words are
+    counted as written, `counts` folds them like WordCloud.process_text.
+    """
+
+    def __init__(self, stopwords=()):
+        self.stopwords = {w.lower() for w in stopwords}
+        self._counts = Counter()
+
+    def feed(self, text):
+        self._counts.update(message_words(text, self.stopwords))
+
+    def update(self, frequencies):
+        """Add precomputed frequencies, like the ones from the word index."""
+        self._counts.update(filter_stopwords(frequencies, self.stopwords))
+
+    @property
+    def counts(self):
+        return fold_words(self._counts)
+
+
+class TopK:
+    """Bounded-memory approximate counter that keeps the most frequent keys.
+
+    A batched take on Space-Saving: once there are twice `capacity` keys the
+    table is cut back to the top `capacity`. A key arriving afterwards may
+    have been among those evicted, so it starts out with that much possible
+    overcount, tracked as its error. `counts` reports count - error, which
+    never overstates the true count.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._counts = {}
+        self._errors = {}
+        self._floor = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, key):
+        count = self._counts.get(key)
+        if count is None:
+            self._counts[key] = self._floor + 1
+            if self._floor:
+                self._errors[key] = self._floor
+            if len(self._counts) > 2 * self.capacity:
+                self._prune()
+        else:
+            self._counts[key] = count + 1
+
+    def _prune(self):
+        keep = heapq.nlargest(self.capacity, self._counts.items(), key=lambda item: item[1])
+        kept = dict(keep)
+        self._floor = max(
+            self._floor, max(c for k, c in self._counts.items() if k not in kept)
+        )
+        self._errors = {k: e for k, e in self._errors.items() if k in kept}
+        self._counts = kept
+
+    @property
+    def counts(self):
+        counts = {}
+        for key, count in self._counts.items():
+            count -= self._errors.get(key, 0)
+            if count > 0:
+                counts[key] = count
+        return counts
+
+
+class PhraseCounter:
+    """Counts two and three word phrases as messages stream in.
+
+    Phrases don't cross message boundaries, and ones that start or end with
+    a stopword are skipped ("of the" is out, "state of mind" is in). Only
+    about `capacity` phrases are kept, see TopK, so memory stays bounded no
+    matter how much text goes through.
+    """
+
+    def __init__(self, stopwords=(), sizes=(2, 3), capacity=5000):
+        self.stopwords = {w.lower() for w in stopwords}
+        self.sizes = sizes
+        self.top = TopK(capacity)
+
+    def feed(self, text):
+        words = [word.lower() for word in tokenize(strip_urls(text))]
+        for size in self.sizes:
+            for i in range(len(words) - size + 1):
+                if words[i] in self.stopwords or words[i + size - 1] in self.stopwords:
+                    continue
+                self.top.add(" ".join(words[i : i + size]))
+
+    @property
+    def counts(self):
+        return self.top.counts
+
+
+def filter_stopwords(frequencies, stopwords):
+    """Drop stopwords (case-insensitive) from a word -> count mapping."""
+    stopwords = {w.lower() for w in stopwords}
+    return {w: c for w, c in frequencies.items() if w.lower() not in stopwords}
@@ -3,24 +3,77 @@ import asyncio
 import discord
 import functools
 import re
+from datetime import datetime, timedelta, timezone
 from io import BytesIO
-import numpy as np
 import os
-from PIL import Image
+import time
 
 from redbot.core import Config, checks, commands
 from redbot.core.utils.chat_formatting import box, pagify
 from redbot.core.data_manager import cog_data_path
-from wordcloud import WordCloud as WCloud
-from wordcloud import ImageColorGenerator
+from wordcloud import STOPWORDS
+
+from .cache import MaskCache, ResultCache
+from .distinctive import DistinctiveCounter
+from .image import generate
+from .index import WordIndex
+from .ingest import MAX_DOWNLOAD, MaskError, download, is_mask_file, prepare, too_large
+from .renderer import Renderer, RenderQueueFull
+from .settings import (
+    DEFAULTS,
+    GuildSettings,
+    fit_scale,
+    validate_color,
+    validate_format,
+    validate_maxwords,
+    validate_pixels,
+    validate_scale,
+    validate_size,
+)
+from .text import PhraseCounter, WordCounter, count_words
 
 # Special thanks to co-author aikaterna for pressing onward
 # with this cog when I had lost motivation!
 
-URL_RE = re.compile(
-    r"([\w+]+\:\/\/)?([\w\d-]+\.)*[\w-]+[\.\:]\w+([\/\?\=\&\#]?[\w-]+)*\/?", flags=re.I
-)
-# https://stackoverflow.com/questions/6038061/regular-expression-to-find-urls-within-a-string
+BACKFILL_LIMIT = 10000
+INDEX_FLUSH_INTERVAL = 10
+# Channels read at once for multi-channel clouds. discord.py waits out rate
+# limits itself, this just keeps a huge guild from queueing every channel.
+HISTORY_CONCURRENCY = 5
+MULTI_CHANNEL_LIMIT = 1000
+# Seconds between progress message edits while reading channels
+PROGRESS_INTERVAL = 2
+# Time-windowed clouds can read further back, the counts stream either way
+WINDOW_LIMIT = 100000
+
+DURATION_RE = re.compile(r"(\d+)\s?(m|h|d|w)", flags=re.I)
+DURATION_UNITS = {"m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+
+
+def parse_duration(value):
+    """Turn a "24h"/"7d"-style duration into the naive UTC datetime that long
+    ago. Returns None if the value isn't one."""
+    match = DURATION_RE.fullmatch(value)
+    if match is None:
+        return None
+    # Whole minutes, so repeated requests can share a cached result
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    return now - timedelta(**{DURATION_UNITS[match[2].lower()]: int(match[1])})
+
+
+def parse_time_bound(value):
+    """Turn durations, as parse_duration does, or ISO dates into naive UTC
+    datetimes. Returns None if the value is neither."""
+    moment = parse_duration(value)
+    if moment is not None:
+        return moment
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
 
 
 class WordClouds(commands.Cog):
@@ -31,30 +84,174 @@ class WordClouds(commands.Cog):
         self.bot = bot
         self.session = aiohttp.ClientSession()
         self.conf = Config.get_conf(self, identifier=3271169074)
-        default_guild_settings = {
-            "bg_color": "black",
-            "maxwords": 200,
-            "excluded": [],
-            "mask": None,
-            "colormask": False,
-        }
-        self.conf.register_guild(**default_guild_settings)
+        self.conf.register_guild(**DEFAULTS)
+        self.conf.register_global(render_workers=2, mask_max_side=1500)
+        # guild id -> GuildSettings, see _guild_settings
+        self._settings = {}
         self.mask_folder = str(cog_data_path(raw_name="WordClouds")) + "/masks"
 
         if not os.path.exists(self.mask_folder):
             os.mkdir(self.mask_folder)
 
         # Clouds can really just be stored in memory at some point
+        self.masks = MaskCache(self.mask_folder)
+        self.bot.loop.create_task(self._load_settings())
+        self.results = ResultCache()
+
+        # Word counts for indexed channels, fed by the listeners below so
+        # clouds for those channels don't need to re-read history
+        self.index = WordIndex(str(cog_data_path(raw_name="WordClouds")) + "/index.sqlite3")
+        self._indexed = set()
+        self._backfilling = set()
+        self._index_ops = []
+        self._index_lock = asyncio.Lock()
+        self._index_task = self.bot.loop.create_task(self._index_loop())
+
+        # Renders run in their own processes, away from the bot's thread pool
+        self.renderer = Renderer(self.bot.loop)
+        self.bot.loop.create_task(self._load_render_settings())
 
     def cog_unload(self):
         self.bot.loop.create_task(self.session.close())
+        self.renderer.close()
+        self._index_task.cancel()
+        # Flush synchronously, the loop may not get another chance to
+        self.index.apply(self._index_ops)
+        self._index_ops = []
+        self.index.close()
+
+    async def red_delete_data_for_user(self, *, requester, user_id):
+        await self._flush_index()
+        await self.bot.loop.run_in_executor(None, self.index.delete_author, user_id)
+
+    async def _guild_settings(self, guild):
+        settings = self._settings.get(guild.id)
+        if settings is None:
+            settings = GuildSettings(**await self.conf.guild(guild).all())
+            self._settings[guild.id] = settings
+        return settings
+
+    async def _save_settings(self, guild, **changes):
+        """Write settings to Config and the in-memory copy together."""
+        settings = await self._guild_settings(guild)
+        for name, value in changes.items():
+            await self.conf.guild(guild).set_raw(name, value=value)
+            setattr(settings, name, list(value) if isinstance(value, list) else value)
+
+    async def _load_settings(self):
+        for guild_id, data in (await self.conf.all_guilds()).items():
+            # A command may have loaded (and changed) a guild in the meantime
+            self._settings.setdefault(guild_id, GuildSettings(**data))
+
+        # Decode every mask some guild uses, so first clouds don't pay for it
+        masks = {}
+        for settings in self._settings.values():
+            if settings.mask:
+                masks[settings.mask] = masks.get(settings.mask, False) or settings.colormask
+        for mask_name, colormask in masks.items():
+            try:
+                await self.bot.loop.run_in_executor(None, self.masks.get, mask_name, colormask)
+            except (OSError, ValueError):
+                pass
+
+    async def _load_render_settings(self):
+        self.renderer.set_workers(await self.conf.render_workers())
+
+    async def _index_loop(self):
+        await self.bot.wait_until_red_ready()
+        for guild_id, data in (await self.conf.all_guilds()).items():
+            self._indexed.update(data.get("indexed_channels", []))
+        # Catch up on whatever was said while the cog was unloaded
+        for channel_id in list(self._indexed):
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                continue
+            newest = await self.bot.loop.run_in_executor(
+                None, self.index.newest_message_id, channel_id
+            )
+            after = discord.Object(id=newest) if newest else None
+            try:
+                await self._backfill(channel, after=after)
+            except discord.errors.HTTPException:
+                pass
+        while True:
+            await asyncio.sleep(INDEX_FLUSH_INTERVAL)
+            await self._flush_index()
+
+    async def _flush_index(self):
+        async with self._index_lock:
+            ops, self._index_ops = self._index_ops, []
+            if ops:
+                await self.bot.loop.run_in_executor(None, self.index.apply, ops)
+
+    async def _backfill(self, channel, after=None):
+        # Ops share the live queue so a delete seen after a message was read
+        # is still applied after that message's add
+        prefixes = await self.bot.get_valid_prefixes(channel.guild)
+        async for message in channel.history(limit=BACKFILL_LIMIT, after=after):
+            if not message.author.bot and not self._is_cloud_request(message, prefixes):
+                self._index_ops.append(self._index_add_op(message))
+        await self._flush_index()
+
+    @staticmethod
+    def _index_add_op(message):
+        return (
+            "add",
+            message.guild.id,
+            message.channel.id,
+            message.author.id,
+            message.id,
+            count_words(message.clean_content),
+        )
+
+    def _is_indexed(self, channel_id):
+        return channel_id in self._indexed or channel_id in self._backfilling
 
-    async def red_delete_data_for_user(self, **kwargs):
-        """Nothing to delete."""
-        return
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if not self._is_indexed(message.channel.id) or message.author.bot:
+            return
+        if self._is_cloud_request(message, await self.bot.get_valid_prefixes(message.guild)):
+            return
+        self._index_ops.append(self._index_add_op(message))
+
+    @commands.Cog.listener()
+    async def on_message_edit(self, before, after):
+        if not self._is_indexed(after.channel.id) or before.content == after.content:
+            return
+        self._index_ops.append(("edit", after.id, count_words(after.clean_content)))
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload):
+        # Cached messages are handled by on_message_edit. The raw content
+        # has mention markup, so fetch the message to index the same text
+        # as adds do.
+        if payload.cached_message is not None or not self._is_indexed(payload.channel_id):
+            return
+        if payload.data.get("content") is None:
+            # Embed-only update, the text didn't change
+            return
+        channel = self.bot.get_channel(payload.channel_id)
+        if channel is None:
+            return
+        try:
+            message = await channel.fetch_message(payload.message_id)
+        except discord.HTTPException:
+            return
+        self._index_ops.append(("edit", message.id, count_words(message.clean_content)))
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        if self._is_indexed(payload.channel_id):
+            self._index_ops.append(("delete", payload.message_id))
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        if self._is_indexed(payload.channel_id):
+            self._index_ops.extend(("delete", m) for m in payload.message_ids)
 
     async def _list_masks(self, ctx):
-        masks = sorted(os.listdir(self.mask_folder))
+        masks = sorted(m for m in os.listdir(self.mask_folder) if is_mask_file(m))
 
         if len(masks) == 0:
             return await ctx.send(
@@ -72,23 +269,70 @@ class WordClouds(commands.Cog):
 
     @commands.guild_only()
     @commands.command(name="wordcloud", aliases=["wc"])
-    @commands.cooldown(1, 15, commands.BucketType.guild)
+    @commands.cooldown(1, 5, commands.BucketType.guild)
     async def wordcloud(self, ctx, *argv):
-        """Generate a wordcloud. Optional arguments are channel, user, and
-        message limit (capped at 10,000)."""
+        """Generate a wordcloud. Optional arguments are channels, user,
+        message limit per channel (capped at 10,000) and a time window.
+
+        Pass `server` instead of channels to use every channel you can read.
+        With more than one channel the limit defaults to 1,000 per channel.
+
+        Time windows are `after=` and/or `before=`, each either a date like
+        `2021-03-01` or a duration ago like `24h`, `7d`. A bare duration such
+        as `30d` means the last 30 days. Windowed clouds may read up to
+        100,000 messages per channel.
+
+        Pass `phrases` for a cloud of two and three word phrases, or
+        `distinctive` with a user for the words that set them apart from
+        everyone else in the channel."""
 
         author = ctx.author
-        channel = ctx.channel
+        channels = []
+        whole_guild = False
+        phrases = False
+        distinctive = False
         user = None
-        limit = 10000
+        limit = None
+        after = None
+        before = None
 
         # a bit clunky, see if Red has already implemented converters
         channel_converter = commands.TextChannelConverter()
         member_converter = commands.MemberConverter()
 
         for arg in argv:
+            if arg.lower() in ("server", "guild"):
+                whole_guild = True
+                continue
+
+            if arg.lower() == "phrases":
+                phrases = True
+                continue
+
+            if arg.lower() == "distinctive":
+                distinctive = True
+                continue
+
+            bound, equals, value = arg.partition("=")
+            if equals and bound.lower() in ("after", "before"):
+                moment = parse_time_bound(value)
+                if moment is None:
+                    await ctx.send("I don't understand the time `{}`.".format(value))
+                    return
+                if bound.lower() == "before":
+                    before = moment
+                else:
+                    after = moment
+                continue
+
+            # Only durations can stand alone, Python 3.11 reads some IDs as dates
+            moment = parse_duration(arg)
+            if moment is not None:
+                after = moment
+                continue
+
             try:
-                channel = await channel_converter.convert(ctx, arg)
+                channels.append(await channel_converter.convert(ctx, arg))
                 continue
             except discord.ext.commands.BadArgument:
                 pass
@@ -99,38 +343,62 @@ class WordClouds(commands.Cog):
             except discord.ext.commands.BadArgument:
                 pass
 
-            if arg.isdecimal() and int(arg) <= 10000:
+            if arg.isdecimal():
                 limit = int(arg)
 
-        guild = channel.guild
+        windowed = after is not None or before is not None
+        if limit is not None and limit > (WINDOW_LIMIT if windowed else 10000):
+            limit = None
+
+        guild = ctx.guild
+
+        if distinctive and (user is None or phrases):
+            await ctx.send("Distinctive clouds need a user, and can't be combined with phrases.")
+            return
+
+        if whole_guild:
+            channels = [
+                c
+                for c in guild.text_channels
+                if c.permissions_for(author).read_messages
+                and c.permissions_for(guild.me).read_message_history
+            ]
+        else:
+            channels = list(dict.fromkeys(channels)) or [ctx.channel]
+        if limit is None:
+            if windowed:
+                limit = WINDOW_LIMIT
+            else:
+                limit = 10000 if len(channels) == 1 else MULTI_CHANNEL_LIMIT
 
         # Verify that wordcloud requester is not being a sneaky snek
-        if not channel.permissions_for(author).read_messages or guild != ctx.guild:
-            await ctx.send("\N{SMIRKING FACE} Nice try.")
+        for channel in channels:
+            if not channel.permissions_for(author).read_messages or channel.guild != guild:
+                await ctx.send("\N{SMIRKING FACE} Nice try.")
+                return
+
+        if not channels:
+            await ctx.send("Wordcloud creation failed. I can't see any channels here!")
             return
 
-        # Default settings
+        settings = await self._guild_settings(guild)
         mask = None
         coloring = None
-        width = 800
-        height = 600
-        mode = "RGB"
-        bg_color = await self.conf.guild(guild).bgcolor()
-        if bg_color == "clear":
-            mode += "A"
-            bg_color = None
-        max_words = await self.conf.guild(guild).maxwords()
-        if max_words == 0:
-            max_words = 200
-        excluded = await self.conf.guild(guild).excluded()
-        if not excluded:
-            excluded = None
-
-        mask_name = await self.conf.guild(guild).mask()
+        width = settings.width
+        height = settings.height
+        scale = settings.scale
+        output_format = settings.output_format
+        quality = settings.quality
+        bg_color, mode = settings.background
+        max_words = settings.max_words
+        excluded = settings.excluded or None
+
+        mask_name = settings.mask
         if mask_name is not None:
-            mask_file = f"{self.mask_folder}/{mask_name}"
             try:
-                mask = np.array(Image.open(mask_file))
+                mask, coloring = await self.bot.loop.run_in_executor(
+                    None, self.masks.get, mask_name, settings.colormask
+                )
             except FileNotFoundError:
                 await ctx.send(
                     "I could not load your mask file. It may "
@@ -138,8 +406,12 @@ class WordClouds(commands.Cog):
                     "may resolve this.".format(ctx.prefix)
                 )
                 return
-            if await self.conf.guild(guild).colormask():
-                coloring = ImageColorGenerator(mask)
+        # Masks set the size, and settings from before the pixel limit
+        # may be over it
+        if mask is not None:
+            scale = fit_scale(mask.shape[1], mask.shape[0], scale)
+        else:
+            scale = fit_scale(width, height, scale)
 
         kwargs = {
             "mask": mask,
@@ -150,27 +422,122 @@ class WordClouds(commands.Cog):
             "stopwords": excluded,
             "width": width,
             "height": height,
+            "scale": scale,
+            "output_format": output_format,
+            "quality": quality,
+            "size_limit": guild.filesize_limit,
         }
 
-        msg = "Generating wordcloud for **" + guild.name + "/" + channel.name
+        if whole_guild:
+            source = guild.name + "/all channels"
+        elif len(channels) == 1:
+            source = guild.name + "/" + channels[0].name
+        else:
+            source = guild.name + "/" + ", ".join(c.name for c in channels)
         if user is not None:
-            msg += "/" + user.display_name
-        msg += "** using the last {} messages. (this might take a while)".format(limit)
-
-        await ctx.send(msg)
+            source += "/" + user.display_name
+        if len(channels) == 1:
+            source += "** using the last {} messages".format(limit)
+        else:
+            source += "** using the last {} messages per channel".format(limit)
+        if after is not None:
+            source += " after {:%Y-%m-%d %H:%M}".format(after)
+        if before is not None:
+            source += " before {:%Y-%m-%d %H:%M}".format(before)
+        source += " UTC" if windowed else ""
+        if phrases:
+            source += ", counting phrases."
+        elif distinctive:
+            source += ", showing words distinctive to {}.".format(user.display_name)
+        else:
+            source += "."
 
-        text = ""
+        prefixes = await self.bot.get_valid_prefixes(guild)
         try:
-            async for message in channel.history(limit=limit):
-                if not message.author.bot:
-                    if user is None or user == message.author:
-                        text += message.clean_content + " "
-            text = URL_RE.sub("", text)
+            newest = [await self._newest_message_id(c, ctx, prefixes) for c in channels]
         except discord.errors.Forbidden:
             await ctx.send("Wordcloud creation failed. I can't see that channel!")
             return
+        # Anything that changes the image has to be part of this
+        key = self.results.fingerprint(
+            [c.id for c in channels],
+            user.id if user is not None else None,
+            newest,
+            limit,
+            phrases,
+            distinctive,
+            after,
+            before,
+            bg_color,
+            max_words,
+            sorted(excluded or []),
+            mask_name,
+            self._mask_mtime(mask_name),
+            coloring is not None,
+            width,
+            height,
+            scale,
+            output_format,
+            quality,
+        )
+        cached = self.results.get(key)
+        if cached is not None:
+            msg = "Wordcloud for **" + source
+            filename, data = cached
+            await ctx.send(msg, file=discord.File(BytesIO(data), filename=filename))
+            return
 
-        if not text or text.isspace():
+        # The index only has single words
+        indexed = [c for c in channels if c.id in self._indexed and not phrases]
+        msg = "Generating wordcloud for **" + source
+        if len(indexed) < len(channels):
+            msg += " (this might take a while)"
+        progress = await ctx.send(msg)
+
+        stopwords = excluded or STOPWORDS
+        if indexed:
+            await self._flush_index()
+        # Shared by all channels, fetches interleave but never run at once
+        if phrases:
+            counter = PhraseCounter(stopwords)
+        elif distinctive:
+            counter = DistinctiveCounter(stopwords)
+        else:
+            counter = WordCounter(stopwords)
+        failed = 0
+        done = 0
+        last_update = time.monotonic()
+        semaphore = asyncio.Semaphore(HISTORY_CONCURRENCY)
+
+        # Snowflakes, so both the index and history can bound by message id
+        after_id = discord.utils.time_snowflake(after) if after is not None else None
+        before_id = discord.utils.time_snowflake(before) if before is not None else None
+
+        async def fetch(channel):
+            nonlocal failed, done, last_update
+            async with semaphore:
+                try:
+                    await self._count_channel(
+                        channel, counter, user, limit, prefixes, after_id, before_id
+                    )
+                except discord.errors.Forbidden:
+                    failed += 1
+            done += 1
+            if len(channels) > 1 and time.monotonic() - last_update > PROGRESS_INTERVAL:
+                last_update = time.monotonic()
+                try:
+                    await progress.edit(content=msg + "\nRead {}/{} channels.".format(done, len(channels)))
+                except discord.errors.HTTPException:
+                    pass
+
+        await asyncio.gather(*(fetch(c) for c in channels))
+
+        if failed == len(channels):
+            await ctx.send("Wordcloud creation failed. I can't see that channel!")
+            return
+        frequencies = counter.counts
+
+        if not frequencies:
             await ctx.send(
                 "Wordcloud creation failed. I couldn't find "
                 "any words. You may have entered a very small "
@@ -179,29 +546,95 @@ class WordClouds(commands.Cog):
             )
             return
 
-        task = functools.partial(self.generate, text, **kwargs)
-        task = self.bot.loop.run_in_executor(None, task)
         try:
-            image = await asyncio.wait_for(task, timeout=45)
+            job = self.renderer.submit(guild.id, self.generate, frequencies, **kwargs)
+        except RenderQueueFull:
+            await ctx.send("Too many wordclouds are being generated right now. Try again later.")
+            return
+        position = self.renderer.position(job)
+        if position:
+            await ctx.send("Your wordcloud is number {} in the queue.".format(position))
+        try:
+            image, timings = await self.renderer.result(job, timeout=45)
         except asyncio.TimeoutError:
             await ctx.send("Wordcloud creation timed out.")
             return
-        msg = "Wordcloud for **" + guild.name + "/" + channel.name
-        if user is not None:
-            msg += "/" + user.display_name
-        msg += "** using the last {} messages.".format(limit)
+        size = image.getbuffer().nbytes
+        if size > guild.filesize_limit:
+            await ctx.send("Wordcloud creation failed. The image is too large to upload here.")
+            return
+        msg = "Wordcloud for **" + source
+        msg += "\nRendered in {:.1f}s, encoded as {} ({:.0f} KiB) in {:.2f}s.".format(
+            timings["layout"], image.name.rpartition(".")[2].upper(), size / 1024, timings["encode"]
+        )
+        self.results.put(key, image.name, image.getvalue())
         await ctx.send(msg,file=discord.File(image))
 
+    async def _count_channel(self, channel, counter, user, limit, prefixes, after=None, before=None):
+        """Feed one channel's words to a counter, from the index if it has one.
+
+        `after` and `before` are exclusive message id bounds."""
+        if channel.id in self._indexed and not isinstance(counter, PhraseCounter):
+            # The index only has single words
+            query = functools.partial(
+                self.index.frequencies, channel.id, limit=limit, after=after, before=before
+            )
+            if isinstance(counter, DistinctiveCounter):
+                everyone = await self.bot.loop.run_in_executor(None, query)
+                query = functools.partial(query, author_id=user.id)
+                counter.update(await self.bot.loop.run_in_executor(None, query), everyone)
+            else:
+                query = functools.partial(query, author_id=user.id if user is not None else None)
+                counter.update(await self.bot.loop.run_in_executor(None, query))
+            return
+
+        distinctive = isinstance(counter, DistinctiveCounter)
+        before = discord.Object(id=before) if before is not None else None
+        # Newest first, so pagination can stop at the start of the window.
+        # Passing after= to history() would filter, but keep paginating.
+        async for message in channel.history(limit=limit, before=before, oldest_first=False):
+            if after is not None and message.id <= after:
+                break
+            if message.author.bot or self._is_cloud_request(message, prefixes):
+                continue
+            if distinctive:
+                # Everyone's messages are the baseline
+                counter.feed(message.clean_content, message.author == user)
+            elif user is None or user == message.author:
+                counter.feed(message.clean_content)
+
+    async def _newest_message_id(self, channel, ctx, prefixes):
+        if channel != ctx.channel:
+            # Free, but counts bot messages, so it's only a little pessimistic
+            return channel.last_message_id
+        # Earlier wordcloud requests don't change what the cloud looks like
+        async for message in channel.history(limit=100):
+            if not message.author.bot and not self._is_cloud_request(message, prefixes):
+                return message.id
+        return None
+
     @staticmethod
-    def generate(text, **kwargs):
-        # Designed to be run in executor to avoid blocking
-        wc = WCloud(**kwargs)
-        wc.generate(text)
-        file = BytesIO()
-        file.name = "wordcloud.png"
-        wc.to_file(file)
-        file.seek(0)
-        return file
+    def _is_cloud_request(message, prefixes):
+        """Whether a message is a wordcloud command, with any of the guild's prefixes.
+
+        Used by history and the index alike, so both count the same messages."""
+        content = message.content
+        return any(
+            content.startswith(prefix)
+            and content[len(prefix) :].split(maxsplit=1)[:1] in (["wordcloud"], ["wc"])
+            for prefix in prefixes
+        )
+
+    def _mask_mtime(self, mask_name):
+        if mask_name is None:
+            return None
+        try:
+            return os.stat(f"{self.mask_folder}/{mask_name}").st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    # Lives in .image so it can be benchmarked without Red
+    generate = staticmethod(generate)
 
     @commands.guild_only()
     @commands.group(name="wcset")
@@ -221,11 +654,10 @@ class WordClouds(commands.Cog):
         - place masks in the cog's data folder/masks/"""
         guild = ctx.guild
         mask_path = f"{self.mask_folder}/{filename}"
-        if not os.path.isfile(mask_path):
-            print(mask_path)
+        if not is_mask_file(filename) or not os.path.isfile(mask_path):
             await ctx.send("That's not a valid filename.")
             return await self._list_masks(ctx)
-        await self.conf.guild(guild).mask.set(filename)
+        await self._save_settings(guild, mask=filename)
         await ctx.send("Mask set to {}.".format(filename))
 
     @wcset.command(name="upload")
@@ -242,28 +674,45 @@ class WordClouds(commands.Cog):
 
         if attachments:
             filename = attachments[0].filename
-            filepath = f"{self.mask_folder}/{filename}"
-            try:
-                await attachments[0].save(filepath)
-            except:
-                ctx.send("Saving attachment failed.")
-                return
-
         elif url:
-            filename = url.split("/")[-1].replace("%20", "_")
-            filepath = f"{self.mask_folder}/{filename}"
-            async with self.session.get(url) as new_image:
-                # Overwrite file if it exists
-                f = open(str(filepath), "wb")
-                f.write(await new_image.read())
-                f.close()
-
+            filename = url.split("?")[0].split("/")[-1].replace("%20", "_")
         else:
             await ctx.send(
                 "You must provide either a Discord attachment " "or a direct link to an image"
             )
             return
 
+        filename = os.path.basename(filename)
+        if not filename or not is_mask_file(filename):
+            await ctx.send("That's not a usable filename for a mask.")
+            return
+        filepath = f"{self.mask_folder}/{filename}"
+        # Downloads land in a hidden file until they're validated
+        partpath = f"{self.mask_folder}/.{filename}.part"
+
+        try:
+            async with ctx.typing():
+                if attachments:
+                    if attachments[0].size > MAX_DOWNLOAD:
+                        raise MaskError(too_large(MAX_DOWNLOAD))
+                    data = await attachments[0].read()
+                    await self.bot.loop.run_in_executor(None, self._write_file, partpath, data)
+                else:
+                    await download(self.session, url, partpath, self.bot.loop)
+                max_side = await self.conf.mask_max_side()
+                # Overwrites the mask if it exists
+                await self.bot.loop.run_in_executor(None, prepare, partpath, filepath, max_side)
+        except MaskError as e:
+            await ctx.send(str(e))
+            return
+        except (aiohttp.ClientError, discord.HTTPException):
+            await ctx.send("Downloading that image failed.")
+            return
+        finally:
+            if os.path.exists(partpath):
+                os.remove(partpath)
+        self.masks.discard(filename)
+
         msg = await ctx.send(
             "Mask {} added. Set as current mask for this server?".format(filename)
         )
@@ -276,7 +725,7 @@ class WordClouds(commands.Cog):
 
         try:
             await self.bot.wait_for("reaction_add", timeout=60.0, check=check)
-            await self.conf.guild(guild).mask.set(filename)
+            await self._save_settings(guild, mask=filename)
             await ctx.send("Mask for this server set to uploaded file.")
         except asyncio.TimeoutError:
             # Can add an timeout message, but not really necessary
@@ -285,58 +734,205 @@ class WordClouds(commands.Cog):
         finally:
             await msg.clear_reactions()
 
+    @staticmethod
+    def _write_file(path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+
     @wcset.command(name="clearmask")
     async def _wcset_clearmask(self, ctx):
         """Clear image file for masking"""
         guild = ctx.guild
-        await self.conf.guild(guild).mask.set(None)
+        await self._save_settings(guild, mask=None)
         await ctx.send("Mask set to None.")
 
     @wcset.command(name="colormask")
     async def _wcset_colormask(self, ctx, on_off: bool = None):
         """Turn color masking on/off"""
         guild = ctx.guild
-        if await self.conf.guild(guild).colormask():
-            await self.conf.guild(guild).colormask.set(False)
+        if (await self._guild_settings(guild)).colormask:
+            await self._save_settings(guild, colormask=False)
             await ctx.send("Color masking turned off.")
         else:
-            await self.conf.guild(guild).colormask.set(True)
+            await self._save_settings(guild, colormask=True)
             await ctx.send("Color masking turned on.")
 
     @wcset.command(name="bgcolor")
     async def _wcset_bgcolor(self, ctx, color: str):
         """Set background color. Use 'clear' for transparent."""
-        # No checks for bad colors yet
         guild = ctx.guild
-        await self.conf.guild(guild).bgcolor.set(color)
+        try:
+            color = validate_color(color)
+        except ValueError as e:
+            await ctx.send(str(e))
+            return
+        await self._save_settings(guild, bgcolor=color)
         await ctx.send("Background color set to {}.".format(color))
 
     @wcset.command(name="maxwords")
     async def _wcset_maxwords(self, ctx, count: int):
         """Set maximum number of words to appear in the word cloud
-        Set to 0 for default (4000)."""
-        # No checks for bad values yet
+        Set to 0 for default (200)."""
         guild = ctx.guild
-        await self.conf.guild(guild).maxwords.set(count)
+        try:
+            count = validate_maxwords(count)
+        except ValueError as e:
+            await ctx.send(str(e))
+            return
+        await self._save_settings(guild, maxwords=count)
         await ctx.send("Max words set to {}.".format(str(count)))
 
+    @wcset.command(name="size")
+    async def _wcset_size(self, ctx, width: int, height: int):
+        """Set the wordcloud width and height in pixels.
+
+        Masks override this, clouds take the shape of the mask."""
+        try:
+            width, height = validate_size(width, height)
+            settings = await self._guild_settings(ctx.guild)
+            validate_pixels(width, height, settings.scale)
+        except ValueError as e:
+            await ctx.send(str(e))
+            return
+        await self._save_settings(ctx.guild, width=width, height=height)
+        await ctx.send("Wordcloud size set to {}x{}.".format(width, height))
+
+    @wcset.command(name="scale")
+    async def _wcset_scale(self, ctx, scale: float):
+        """Set the output scale.
+
+        Words are laid out at the set size, then drawn this many times larger.
+        Higher values give sharper images, at the cost of render time."""
+        try:
+            scale = validate_scale(scale)
+            settings = await self._guild_settings(ctx.guild)
+            validate_pixels(settings.width, settings.height, scale)
+        except ValueError as e:
+            await ctx.send(str(e))
+            return
+        await self._save_settings(ctx.guild, scale=scale)
+        await ctx.send("Scale set to {}.".format(scale))
+
+    @wcset.command(name="format")
+    async def _wcset_format(self, ctx, output_format: str, quality: int = 90):
+        """Set the image format: png, webp or jpeg.
+
+        Quality (1-100) applies to webp and jpeg. Images too large for
+        the server's upload limit are re-encoded smaller automatically."""
+        try:
+            output_format, quality = validate_format(output_format, quality)
+        except ValueError as e:
+            await ctx.send(str(e))
+            return
+        await self._save_settings(ctx.guild, output_format=output_format, quality=quality)
+        msg = "Output format set to {}".format(output_format)
+        if output_format != "png":
+            msg += " at quality {}".format(quality)
+        await ctx.send(msg + ".")
+
     @wcset.command(name="exclude")
     async def _wcset_exclude(self, ctx, word: str):
         """Add a word to the excluded list.
         This overrides the default excluded list!"""
         guild = ctx.guild
-        excluded = await self.conf.guild(guild).excluded()
+        excluded = (await self._guild_settings(guild)).excluded
         if word in excluded:
             await ctx.send("'{}' is already in the excluded words.".format(word))
             return
-        excluded.append(word)
-        await self.conf.guild(guild).excluded.set(excluded)
+        await self._save_settings(guild, excluded=excluded + [word])
         await ctx.send("'{}' added to excluded words.".format(word))
 
+    @wcset.command(name="maskcache")
+    async def _wcset_maskcache(self, ctx):
+        """Show mask cache statistics"""
+        masks = self.masks
+        lookups = masks.hits + masks.misses
+        hit_rate = masks.hits / lookups if lookups else 0
+        msg = (
+            f"Cached masks: {len(masks)}\n"
+            f"Memory used: {masks.bytes / 2**20:.1f} / {masks.max_bytes / 2**20:.0f} MiB\n"
+            f"Hits: {masks.hits}\n"
+            f"Misses: {masks.misses}\n"
+            f"Hit rate: {hit_rate:.1%}"
+        )
+        await ctx.send(box(msg, lang="ini"))
+
+    @wcset.command(name="workers")
+    @checks.is_owner()
+    async def _wcset_workers(self, ctx, count: int):
+        """Set how many processes render wordclouds.
+
+        This is bot-wide. More workers render more clouds at once,
+        at the cost of CPU for the rest of the bot."""
+        if not 1 <= count <= (os.cpu_count() or 1):
+            await ctx.send("Worker count must be between 1 and {}.".format(os.cpu_count() or 1))
+            return
+        await self.conf.render_workers.set(count)
+        self.renderer.set_workers(count)
+        await ctx.send("Wordclouds will be rendered by {} worker(s).".format(count))
+
+    @wcset.command(name="maskside")
+    @checks.is_owner()
+    async def _wcset_maskside(self, ctx, pixels: int):
+        """Set the longest side uploaded masks are scaled down to.
+
+        This is bot-wide and applies to masks uploaded from now on."""
+        if not 200 <= pixels <= 4000:
+            await ctx.send("Mask size must be between 200 and 4000 pixels.")
+            return
+        await self.conf.mask_max_side.set(pixels)
+        await ctx.send("Uploaded masks will be scaled to at most {} pixels.".format(pixels))
+
+    @wcset.command(name="index")
+    async def _wcset_index(self, ctx, channel: discord.TextChannel = None):
+        """Toggle the word index for a channel.
+
+        Indexed channels keep running word counts, so clouds for them
+        don't have to re-read message history every time.
+        Turning the index off deletes the stored counts."""
+        guild = ctx.guild
+        channel = channel or ctx.channel
+        if channel.guild != guild:
+            return await ctx.send("That channel isn't in this server.")
+        indexed = (await self._guild_settings(guild)).indexed_channels
+
+        if channel.id in indexed:
+            await self._save_settings(
+                guild, indexed_channels=[c for c in indexed if c != channel.id]
+            )
+            self._indexed.discard(channel.id)
+            await self._flush_index()
+            await self.bot.loop.run_in_executor(None, self.index.clear_channel, channel.id)
+            return await ctx.send("Stopped indexing {}.".format(channel.mention))
+
+        if channel.id in self._backfilling:
+            return await ctx.send("I'm already indexing that channel.")
+
+        await ctx.send(
+            "Indexing the last {} messages in {}. "
+            "(this might take a while)".format(BACKFILL_LIMIT, channel.mention)
+        )
+        self._backfilling.add(channel.id)
+        try:
+            async with ctx.typing():
+                await self._backfill(channel)
+        except discord.errors.Forbidden:
+            await self._flush_index()
+            await self.bot.loop.run_in_executor(None, self.index.clear_channel, channel.id)
+            return await ctx.send("Indexing failed. I can't see that channel!")
+        finally:
+            self._backfilling.discard(channel.id)
+
+        indexed = (await self._guild_settings(guild)).indexed_channels
+        await self._save_settings(guild, indexed_channels=indexed + [channel.id])
+        self._indexed.add(channel.id)
+        count = await self.bot.loop.run_in_executor(None, self.index.message_count, channel.id)
+        await ctx.send("Indexed {} messages in {}.".format(count, channel.mention))
+
     @wcset.command(name="clearwords")
     async def _wcset_clearwords(self, ctx):
         """Clear the excluded word list.
         Default excluded list will be used."""
         guild = ctx.guild
-        await self.conf.guild(guild).excluded.set([])
+        await self._save_settings(guild, excluded=[])
         await ctx.send("Cleared the excluded word list.")